@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import cath
+import dataCreation
+import histogram
+import label_file
+
+'''
+Benchmarks of the labeling, splitting and evaluation hot paths.
+Every stage is measured for several input sizes: the best wall time of --repeat runs, and the peak memory of one more
+run traced by tracemalloc (python and numpy allocations). The inputs are the bundled files (UBDs/*.cif,
+cath-domain-list.txt, datasets/PPBS/labels_test_homology.txt), scaled-up label files built from the PPBS chains and
+synthetic predictions. Everything runs offline, on CPU.
+
+    python benchmark.py                        # all the stages
+    python benchmark.py --stages homology,listCreation --repeat 5 --output benchmark.jsonl
+'''
+
+pdb_folder = 'UBDs'
+cath_filename = 'cath-domain-list.txt'
+ppbs_label_filename = 'datasets/PPBS/labels_test_homology.txt'
+
+
+def parse_structure(pdb_name):
+    """
+    :param pdb_name: pdb id of a structure of pdb_folder
+    :return: the Bio.PDB structure
+    """
+    from Bio.PDB.MMCIFParser import MMCIFParser
+
+    return MMCIFParser(QUIET=True).get_structure(pdb_name, dataCreation.structureFilename(pdb_name, pdb_folder))
+
+
+def labeling_inputs(pdb_name, size):
+    """
+    :param pdb_name: pdb id of a structure of pdb_folder
+    :param size: number of amino acids (None for all the amino acids of the non ubiquitin chains)
+    :return: tuple (amino_acids, ubiq_atoms) as used by structurePPBSFormat
+    """
+    structure = parse_structure(pdb_name)
+    ubiq_chains_id = dataCreation.findUbiqChains(dataCreation.structureFilename(pdb_name, pdb_folder))
+    ubiq_atoms = [atom for id in ubiq_chains_id for aa in dataCreation.aaOutOfChain(structure[0][id])
+                  for atom in aa.get_atoms()]
+    amino_acids = [aa for chain in structure.get_chains() if str(chain.get_id()) not in ubiq_chains_id
+                   for aa in dataCreation.aaOutOfChain(chain)]
+    return amino_acids[:size], ubiq_atoms
+
+
+def scaled_label_file(factor, folder):
+    """
+    :param factor: number of copies of the PPBS chains
+    :param folder: directory to write to
+    :return: path of a text label file with factor copies of the chains of ppbs_label_filename (renamed copies)
+    """
+    table = label_file.read_label_file(ppbs_label_filename)
+    copies = []
+    for copy in range(factor):
+        copy_table = dict(table)
+        copy_table['names'] = ['%s%s' % (name, copy) if copy > 0 else name for name in table['names']]
+        copies.append(copy_table)
+    filename = os.path.join(folder, 'labels_x%s.txt' % factor)
+    label_file.write_label_file(label_file.concatenate_tables(copies), filename)
+    return filename
+
+
+def synthetic_predictions(size, seed=0):
+    """
+    :param size: number of residues
+    :return: tuple (labels, predictions), object arrays of chains of 250 residues: one-hot labels [Naa,2] with 10%
+    positives and predictions correlated with the labels
+    """
+    rng = np.random.default_rng(seed)
+    positives = rng.random(size) < 0.1
+    predictions = np.clip(rng.normal(0.2 + 0.4 * positives, 0.2), 0, 1)
+    labels = np.stack([~positives, positives], axis=1).astype(np.int64)
+    bounds = np.arange(250, size, 250)
+    chains_labels = np.empty(len(bounds) + 1, dtype=object)
+    chains_predictions = np.empty(len(bounds) + 1, dtype=object)
+    for i, (label, prediction) in enumerate(zip(np.split(labels, bounds), np.split(predictions, bounds))):
+        chains_labels[i] = label
+        chains_predictions[i] = prediction
+    return chains_labels, chains_predictions
+
+
+'''
+Each stage is a function (size, folder) -> function without arguments that runs the measured code once.
+Building the inputs is not measured.
+'''
+
+
+def stage_getLabelForAA(size, folder):
+    amino_acids, ubiq_atoms = labeling_inputs('1NBF', size)
+    return lambda: [dataCreation.getLabelForAA(aa, ubiq_atoms, 4) for aa in amino_acids]
+
+
+def stage_getPartnerDistancesForAAs(size, folder):
+    amino_acids, ubiq_atoms = labeling_inputs('1NBF', size)
+    return lambda: dataCreation.getPartnerDistancesForAAs(amino_acids, [ubiq_atoms])
+
+
+def stage_structureToShard(size, folder):
+    cache_folder = os.path.join(folder, 'structure_cache')
+    tasks = [(pdb_name, dataCreation.structureFilename(pdb_name, pdb_folder),
+              dataCreation.shardFilename(pdb_name, folder), cache_folder, False, None)
+             for pdb_name in dataCreation.PDB_names_list[:size]]
+    for task in tasks:  # the structures are parsed once, the runs read their records as the label stage does
+        dataCreation.structureToShard(task)
+    return lambda: [dataCreation.structureToShard(task) for task in tasks]
+
+
+def stage_MMCIFParser(size, folder):
+    pdb_names = dataCreation.PDB_names_list[:size]
+    return lambda: [parse_structure(pdb_name) for pdb_name in pdb_names]
+
+
+def stage_findUbiqChains(size, folder):
+    filenames = [dataCreation.structureFilename(pdb_name, pdb_folder) for pdb_name in dataCreation.PDB_names_list]
+    filenames = filenames[:size]
+    return lambda: [dataCreation.findUbiqChains(filename) for filename in filenames]
+
+
+def stage_make_cath_df(size, folder):
+    return lambda: cath.make_cath_df(cath_filename, 4)
+
+
+def stage_homology(size, folder):
+    nameList, sizeList, seqList, positivesList = cath.listCreation(scaled_label_file(1, folder))
+    nameList, seqList = nameList[:size], seqList[:size]
+    cath_df = cath.make_cath_df(cath_filename, 4)
+
+    def run():
+        cacheFilename = os.path.join(folder, 'identity_cache.txt')
+        if os.path.exists(cacheFilename):  # every run aligns all the pairs
+            os.remove(cacheFilename)
+        homologous = cath.UnionFind(len(nameList))
+        homologous.addEdges(cath.homologyEdges(cath_df, nameList, seqList, 4, cacheFilename=cacheFilename, ncores=1))
+        return homologous.clusters(sizeList[:size])
+    return run
+
+
+def stage_listCreation(size, folder):
+    filename = scaled_label_file(size, folder)
+    return lambda: cath.listCreation(filename)
+
+
+def stage_load_label_table(size, folder):
+    filename = scaled_label_file(size, folder)
+    label_file.convert(filename, filename[:-4] + '.labels')
+
+    def run():  # open the binary file and read a single chain (random access)
+        table = label_file.load_label_table(filename[:-4] + '.labels')
+        return label_file.get_chain(table, len(table['names']) // 2)
+    return run
+
+
+def stage_dividePSSM(size, folder):
+    filename = scaled_label_file(size, folder)
+    names, _ = label_file.chain_index(filename)
+    chainDict = {name[0:4] + name[-1]: i % 5 for i, name in enumerate(names)}
+    output_folder = os.path.join(folder, 'folds')
+    os.makedirs(output_folder, exist_ok=True)
+
+    return lambda: cath.dividePSSM(chainDict, 5, filename, output_folder)
+
+
+def stage_create_label_lists(size, folder):
+    labels, predictions = synthetic_predictions(size)
+    return lambda: histogram.create_label_lists(labels, predictions)
+
+
+def stage_find_thresholds(size, folder):
+    label0_list, label1_list = histogram.create_label_lists(*synthetic_predictions(size))
+    return lambda: histogram.find_thresholds(label0_list, label1_list, precisions=[0.333, 0.5, 0.25])
+
+
+def stage_MetricsAccumulator(size, folder):
+    labels, predictions = synthetic_predictions(size)
+
+    def run():
+        metrics = histogram.MetricsAccumulator(bins=1000)
+        metrics.update(labels, predictions)
+        return metrics.thresholds(precisions=[0.333, 0.5, 0.25]), metrics.auc_pr()
+    return run
+
+
+stages = {  # stage name: (stage function, input sizes)
+    'getLabelForAA': (stage_getLabelForAA, [10, 25]),  # amino acids of 1NBF (pairwise loop, slow)
+    'getPartnerDistancesForAAs': (stage_getPartnerDistancesForAAs, [25, 100, None]),  # amino acids of 1NBF
+    'structureToShard': (stage_structureToShard, [1, 10, 52]),  # structures, from their cached records
+    'MMCIFParser': (stage_MMCIFParser, [1, 5]),  # structures
+    'findUbiqChains': (stage_findUbiqChains, [10, 52]),  # structures
+    'make_cath_df': (stage_make_cath_df, [1]),
+    'homology': (stage_homology, [50, 100, 200]),  # chains
+    'listCreation': (stage_listCreation, [1, 4, 16]),  # copies of the PPBS chains
+    'load_label_table': (stage_load_label_table, [1, 4, 16]),  # copies of the PPBS chains
+    'dividePSSM': (stage_dividePSSM, [1, 4, 16]),  # copies of the PPBS chains
+    'create_label_lists': (stage_create_label_lists, [10 ** 4, 10 ** 5, 10 ** 6]),  # residues
+    'find_thresholds': (stage_find_thresholds, [10 ** 4, 10 ** 5, 10 ** 6]),  # residues
+    'MetricsAccumulator': (stage_MetricsAccumulator, [10 ** 4, 10 ** 5, 10 ** 6]),  # residues
+}
+
+
+def measure(run, repeat):
+    """
+    :param run: function without arguments
+    :param repeat: number of timed runs
+    :return: tuple (best wall time in seconds, peak traced memory in bytes)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def run_benchmarks(stage_names, repeat, output_filename=None):
+    """
+    :param stage_names: names of the stages to run (keys of stages)
+    :param repeat: number of timed runs of each stage and size
+    :param output_filename: optional file, one json line per stage and size is appended to it
+    :return: list of the results dicts (stage, size, seconds, peak_mb)
+    """
+    results = []
+    print('%-26s %10s %12s %12s' % ('stage', 'size', 'seconds', 'peak MB'))
+    for stage_name in stage_names:
+        stage, sizes = stages[stage_name]
+        for size in sizes:
+            folder = tempfile.mkdtemp(prefix='ubiqpred_benchmark_')
+            try:
+                seconds, peak = measure(stage(size, folder), repeat)
+            finally:
+                shutil.rmtree(folder)
+            result = {'stage': stage_name, 'size': size, 'seconds': seconds, 'peak_mb': peak / 2 ** 20}
+            print('%-26s %10s %12.4f %12.1f' % (stage_name, size, seconds, result['peak_mb']))
+            results.append(result)
+            if output_filename is not None:
+                with open(output_filename, 'a') as output_file:
+                    output_file.write(json.dumps(result) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks of the UbiqPred stages')
+    parser.add_argument('--stages', default=','.join(stages), help='comma separated stage names, default: all')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each stage and size')
+    parser.add_argument('--output', default=None, help='json lines file to append the results to')
+    args = parser.parse_args()
+    run_benchmarks(args.stages.split(','), args.repeat, args.output)
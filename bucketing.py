@@ -0,0 +1,172 @@
+import numpy as np
+
+
+def chain_lengths(outputs):
+    """
+    :param outputs: per chain labels (or any per residue per chain array)
+    :return: numpy array of the chains number of residues
+    """
+    return np.array([len(output) for output in outputs])
+
+
+def make_buckets(lengths, boundaries):
+    """
+    :param lengths: numpy array of the chains number of residues
+    :param boundaries: sorted list of the buckets padding lengths, the last one is Lmax
+    :return: list of tuples (padding_length, chain indexes). each chain goes to the smallest padding length that fits it,
+    chains longer than Lmax go to the last bucket (and are truncated by the model as before). empty buckets are dropped
+    """
+    bucket_index = np.minimum(np.searchsorted(boundaries, lengths, side='left'), len(boundaries) - 1)
+    buckets = []
+    for b in range(len(boundaries)):
+        index = np.flatnonzero(bucket_index == b)
+        if len(index) > 0:
+            buckets.append((boundaries[b], index))
+    return buckets
+
+
+def bucket_batch_size(padding_length, token_budget):
+    """
+    :param padding_length: padding length of the bucket
+    :param token_budget: maximal number of (padded) residues in a batch
+    :return: batch size of the bucket
+    """
+    return max(1, token_budget // padding_length)
+
+
+def subset(inputs, index):
+    """
+    :param inputs: list of object arrays of chains
+    :param index: chain indexes
+    :return: list of object arrays with the chains of index (references, not copies)
+    """
+    return [input_[index] for input_ in inputs]
+
+
+def predict_bucketed(bucket_models, inputs, lengths, token_budget):
+    """
+    :param bucket_models: dict, bucket_models[padding_length] = model wrapper built with Lmax = padding_length
+    :param inputs: list of object arrays of chains
+    :param lengths: numpy array of the chains number of residues
+    :param token_budget: maximal number of (padded) residues in a batch
+    :return: object array of the chains binding site probabilities, in the order of inputs
+    """
+    predictions = np.empty(len(lengths), dtype=object)
+    for padding_length, index in make_buckets(lengths, sorted(bucket_models)):
+        bucket_predictions = bucket_models[padding_length].predict(
+            subset(inputs, index),
+            return_all=False,
+            batch_size=bucket_batch_size(padding_length, token_budget))
+        for i, prediction in zip(index, bucket_predictions):
+            predictions[i] = prediction
+    return predictions
+
+
+def crossentropy(outputs, predictions, weights):
+    """
+    :param outputs: object array of the chains one-hot encoded labels [Naa,2]
+    :param predictions: object array of the chains binding site probabilities [Naa]
+    :param weights: chain-wise weights
+    :return: weighted mean of the residues categorical crossentropy
+    """
+    total = 0.
+    total_weight = 0.
+    for output, prediction, weight in zip(outputs, predictions, weights):
+        output = np.asarray(output)[:len(prediction)]
+        prediction = np.clip(prediction, 1e-7, 1 - 1e-7)
+        total += weight * -np.sum(output[:, 1] * np.log(prediction) + output[:, 0] * np.log(1 - prediction))
+        total_weight += weight * np.sum(output.sum(axis=1) > 0)
+    return total / max(total_weight, 1e-12)
+
+
+def set_optimizer_weights(model, optimizer_weights):
+    """
+    :param model: compiled keras model
+    :param optimizer_weights: optimizer state of a model with the same architecture (optimizer.get_weights())
+    The optimizer variables are created by the first update, they are created here first if the model was not trained
+    yet (tf.keras creates them from the trainable weights, standalone keras with the training function)
+    """
+    optimizer = model.optimizer
+    if len(optimizer.weights) != len(optimizer_weights):
+        if hasattr(optimizer, '_create_all_weights'):
+            optimizer._create_all_weights(model.trainable_weights)
+        else:
+            model._make_train_function()
+    optimizer.set_weights(optimizer_weights)
+
+
+def fit_bucketed(bucket_models, inputs, outputs, weights, token_budget, epochs, validation_data=None,
+                 patience=2, min_delta=0.001, lr_factor=0.5, lr_patience=2, lr_cooldown=1, seed=0):
+    """
+    :param bucket_models: dict, bucket_models[padding_length] = compiled model wrapper built with Lmax = padding_length,
+    all with the same architecture and optimizer
+    :param inputs: list of object arrays of chains
+    :param outputs: object array of the chains labels
+    :param weights: chain-wise weights
+    :param token_budget: maximal number of (padded) residues in a batch
+    :param epochs: maximal number of epochs
+    :param validation_data: optional tuple (inputs, outputs, weights)
+    :param patience: number of epochs without validation improvement before stopping (as the EarlyStopping of the
+    regular training, the best weights are restored)
+    :param min_delta: minimal decrease of the validation crossentropy counted as an improvement
+    :param lr_factor: factor of the learning rate when the validation loss reaches a plateau (as the ReduceLROnPlateau
+    of the regular training)
+    :param lr_patience: number of epochs without validation improvement before reducing the learning rate
+    :param lr_cooldown: number of epochs after a reduction before the plateau is counted again
+    :param seed: seed of the buckets order
+    :return: the model of the largest padding length. all the bucket models end with the best weights
+    Every epoch goes over the buckets in a random order, fitting one pass on each bucket with its own padding length
+    and batch size. The weights and the optimizer state (iterations and moment estimates) are carried from one bucket
+    model to the next, so the buckets are trained as by a single optimizer.
+    """
+    import keras.backend as K
+
+    boundaries = sorted(bucket_models)
+    buckets = make_buckets(chain_lengths(outputs), boundaries)
+    rng = np.random.default_rng(seed)
+    current_weights = bucket_models[boundaries[-1]].model.get_weights()
+    current_optimizer_weights = None  # the optimizer state is created by the first update
+    best_loss, best_weights, wait = np.inf, current_weights, 0
+    lr_best_loss, lr_wait, cooldown_counter = np.inf, 0, 0
+    for epoch in range(epochs):
+        for b in rng.permutation(len(buckets)):
+            padding_length, index = buckets[b]
+            model = bucket_models[padding_length]
+            model.model.set_weights(current_weights)
+            if current_optimizer_weights is not None:
+                set_optimizer_weights(model.model, current_optimizer_weights)
+            model.fit(subset(inputs, index), outputs[index], sample_weight=weights[index],
+                      batch_size=bucket_batch_size(padding_length, token_budget), epochs=1)
+            current_weights = model.model.get_weights()
+            current_optimizer_weights = model.model.optimizer.get_weights()
+        if validation_data is None:
+            continue
+        for model in bucket_models.values():
+            model.model.set_weights(current_weights)
+        val_inputs, val_outputs, val_weights = validation_data
+        val_predictions = predict_bucketed(bucket_models, val_inputs, chain_lengths(val_outputs), token_budget)
+        val_loss = crossentropy(val_outputs, val_predictions, val_weights)
+        print('Epoch %s: val_categorical_crossentropy = %.4f' % (epoch + 1, val_loss))
+        if cooldown_counter > 0:
+            cooldown_counter -= 1
+            lr_wait = 0
+        if val_loss < lr_best_loss - min_delta:
+            lr_best_loss, lr_wait = val_loss, 0
+        elif cooldown_counter == 0:
+            lr_wait += 1
+            if lr_wait >= lr_patience:
+                lr = float(K.get_value(bucket_models[boundaries[-1]].model.optimizer.lr)) * lr_factor
+                for model in bucket_models.values():
+                    K.set_value(model.model.optimizer.lr, lr)
+                print('Epoch %s: reducing learning rate to %s.' % (epoch + 1, lr))
+                lr_wait, cooldown_counter = 0, lr_cooldown
+        if val_loss < best_loss - min_delta:
+            best_loss, best_weights, wait = val_loss, current_weights, 0
+        else:
+            wait += 1
+            if wait >= patience:
+                print('Validation loss did not improve for %s epochs, stopping.' % patience)
+                break
+    for model in bucket_models.values():
+        model.model.set_weights(best_weights if validation_data is not None else current_weights)
+    return bucket_models[boundaries[-1]]
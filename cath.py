@@ -1,41 +1,35 @@
+import hashlib
+import heapq
+import os
+from multiprocessing import Pool
+
 import numpy as np
-import pandas as pd
-from Bio import pairwise2
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import connected_components
+
+import instrumentation
+import label_file
 
 
 def listCreation(filename):
     """
-    :param filename: PSSM file
-    :return: tuple(namesList,sizesList)
+    :param filename: PSSM file (text or binary, see label_file)
+    :return: tuple(namesList,sizesList,sequenceList,positivesList)
     namesList = list of all the chains's name in the file
     sizesList = list of all the chains's number of amino acids in the file
+    sequenceList = list of all the chains's sequences
+    positivesList = list of all the chains's number of amino acids with label 1 (for any partner class with
+    multi-column labels)
     """
-    namesList = []
-    sizesList = []
-    sequenceList = []
-    file1 = open(filename, 'r')
-    line = file1.readline().split()
-    cnt = 0
-    seq = ''
-    while len(line) != 0:  # end of file
-        cnt += 1
-        if len(line) == 1:  # in chain header line
-            sequenceList.append(seq)
-            sizesList.append(cnt)
-            namesList.append(line[0][1:5] + line[0][-1])
-            cnt = -1
-            seq = ''
-        else:
-            seq = seq + line[2]  # not chain's name
-        line = file1.readline().split()
-    sizesList.append(cnt)
-    sequenceList.append(seq)
-    sizesList = sizesList[1:]  # first one is redundent
-    sequenceList = sequenceList[1:]
-    file1.close()
-    return namesList, sizesList, sequenceList
+    table = label_file.read_labels(filename)
+    namesList = [name[0:4] + name[-1] for name in table['names']]
+    sizesList = label_file.chain_sizes(table).tolist()
+    sequenceList = [label_file.chain_sequence(table, i) for i in range(len(namesList))]
+    positives = np.asarray(table['labels']) == 1
+    if positives.ndim == 2:
+        positives = positives.any(axis=1)
+    offsets = np.asarray(table['offsets'])
+    cumulative = np.concatenate([[0], np.cumsum(positives)])  # differences of the cumulative sum, 0 for empty chains
+    positivesList = (cumulative[offsets[1:]] - cumulative[offsets[:-1]]).tolist()
+    return namesList, sizesList, sequenceList, positivesList
 
 
 def make_cath_df(filename, columns_number):
@@ -45,6 +39,8 @@ def make_cath_df(filename, columns_number):
     :return: dataframe of all the chains in the file and their cath classification divide to 4 different columns
     """
 
+    import pandas as pd
+
     df = pd.read_csv(filename, skiprows=16, header=None, delimiter=r"\s+")
     df = df.iloc[:, 0:columns_number + 1]
     cath_columns = ["n" + str(i) for i in range(1, columns_number + 1)]
@@ -53,87 +49,400 @@ def make_cath_df(filename, columns_number):
     return df
 
 
-def neighbor_mat(df, nameList, seqList, columns_number):
+aligner = None  # created once in each process by sequenceIdentity
+
+
+def sequenceIdentity(sequences):
+    """
+    :param sequences: tuple (seq1,seq2)
+    :return: the sequence identity of the global alignment with match = 1, mismatch = gap = 0 (pairwise2.globalxx)
+    the score is the number of matched amino acids m and the alignment length is len(seq1) + len(seq2) - m,
+    so only the score is computed and no alignment is built
+    """
+    global aligner
+    if aligner is None:
+        from Bio.Align import PairwiseAligner  # imported here, importing cath does not load Bio
+
+        aligner = PairwiseAligner(mode='global', match_score=1, mismatch_score=0, gap_score=0)
+    seq1, seq2 = sequences
+    matches = aligner.score(seq1, seq2)
+    return matches / (len(seq1) + len(seq2) - matches)
+
+
+def sequenceHash(seq):
+    """
+    :param seq: amino acids sequence
+    :return: hex digest identifying the sequence in the identity cache
+    """
+    return hashlib.sha1(seq.encode()).hexdigest()
+
+
+def loadIdentityCache(cacheFilename):
+    """
+    :param cacheFilename: identity cache file, every line is "hash1 hash2 identity"
+    :return: dict, cache[(hash1,hash2)] = identity (hash1 <= hash2)
+    """
+    cache = {}
+    if os.path.exists(cacheFilename):
+        with open(cacheFilename, 'r') as cacheFile:
+            for line in cacheFile:
+                hash1, hash2, identity = line.split()
+                cache[(hash1, hash2)] = float(identity)
+    return cache
+
+
+def compositionCounts(seqList):
+    """
+    :param seqList: list of sequences
+    :return: numpy array [len(seqList),Nletters], counts[i][c] = number of times the c-th letter (of the letters found
+    in seqList) appears in seqList[i]
+    """
+    counts = np.zeros((len(seqList), 256), dtype=np.int32)
+    for i in range(len(seqList)):
+        counts[i] = np.bincount(np.frombuffer(seqList[i].encode(), dtype=np.uint8), minlength=256)
+    return counts[:, counts.any(axis=0)]
+
+
+def candidatePairs(i, js, counts, lengths, cutoff):
+    """
+    :param i: chain index
+    :param js: numpy array of the chains indexes compared to chain i
+    :param counts: composition counts of the chains (see compositionCounts)
+    :param lengths: numpy array of the chains lengths
+    :param cutoff: minimal sequence identity
+    :return: numpy array, the chains of js whose identity with chain i may reach the cutoff: the number of matches is
+    at most the sum over the amino acids of the minimal count in the two sequences, and the identity grows with the
+    number of matches
+    """
+    maxMatches = np.minimum(counts[i], counts[js]).sum(axis=1)
+    bound = maxMatches / np.maximum(lengths[i] + lengths[js] - maxMatches, 1)
+    return js[(maxMatches > 0) & (bound >= cutoff)]
+
+
+def identityEdges(rows, seqList, cutoff, cacheFilename, ncores):
+    """
+    :param rows: iterable of tuples (i,js), chain i is compared to every chain of the numpy array js
+    :param seqList: list of the chains's sequences
+    :param cutoff: minimal sequence identity of an edge
+    :param cacheFilename: file of the already computed identities, keyed by the sequences hashes. new results are
+    appended to it, so a rerun only aligns the pairs with new sequences
+    :param ncores: number of processes for the alignments
+    :return: list of tuples (i,j) with identity(seqList[i],seqList[j]) >= cutoff
+    The pairs that can not reach the cutoff are skipped row by row before aligning (see candidatePairs), no list of
+    all the compared pairs is built
+    """
+    hashes = [sequenceHash(seq) for seq in seqList]
+    counts = compositionCounts(seqList)
+    lengths = np.array([len(seq) for seq in seqList], dtype=np.int64)
+    cache = loadIdentityCache(cacheFilename)
+    edges = []
+    toAlign = []  # arrays [Npairs,2] of the pairs that are not in the cache and pass the composition bound
+    compared = 0
+    candidates = 0
+    cached = 0
+    for i, js in rows:
+        compared += len(js)
+        js = candidatePairs(i, js, counts, lengths, cutoff)
+        candidates += len(js)
+        uncached = []
+        for j in js.tolist():
+            key = (hashes[i], hashes[j]) if hashes[i] <= hashes[j] else (hashes[j], hashes[i])
+            if key in cache:
+                cached += 1
+                if cache[key] >= cutoff:
+                    edges.append((i, j))
+            else:
+                uncached.append(j)
+        if len(uncached) > 0:
+            toAlign.append(np.stack([np.full(len(uncached), i), uncached], axis=1))
+    toAlign = np.concatenate(toAlign) if len(toAlign) > 0 else np.zeros((0, 2), dtype=np.int64)
+    instrumentation.count('pairs_compared', compared)
+    instrumentation.count('pairs_cached', cached)
+    instrumentation.count('pairs_bounded', compared - candidates)  # skipped by the composition bound
+    instrumentation.count('pairs_aligned', len(toAlign))
+    if len(toAlign) > 0:
+        with Pool(ncores) as pool, open(cacheFilename, 'a') as cacheFile:
+            identities = pool.imap(sequenceIdentity, ((seqList[i], seqList[j]) for i, j in toAlign.tolist()),
+                                   chunksize=16)
+            for (i, j), identity in zip(toAlign.tolist(), identities):
+                key = tuple(sorted((hashes[i], hashes[j])))
+                if key not in cache:
+                    cache[key] = identity
+                    cacheFile.write("{} {} {!r}\n".format(key[0], key[1], identity))
+                if identity >= cutoff:
+                    edges.append((i, j))
+    instrumentation.count('identity_edges', len(edges))
+    return edges
+
+
+def cathEdges(df, nameList, columns_number):
     """
     :param df: cath data frame as it return from the func make_cath_df
-    :param lst: list of chains
+    :param nameList: list of chains
     :param columns_number: the number of columns to consider with the cath classification not include the cath domain name
-    :return: matrix. mat[i][j] == 1 if there is connection between chain i and chain j
+    :return: tuple (rows, cols, not_in_cath). the edges (rows[e], cols[e]) connect the chains that share a CATH
+    classification, all to the first chain of the classification, which keeps the connected components of the graph
+    with a linear number of edges. not_in_cath is the set of the chains names not found in the cath data frame
     """
-    # generate the graph using CATH.
     cath_columns = ["n" + str(i) for i in range(1, columns_number + 1)]
-    not_in_cath = set()
+    chainIndexes = {}  # chainIndexes[chainName] = list of the indexes of chainName in nameList
+    for i in range(len(nameList)):
+        chainIndexes.setdefault(nameList[i], []).append(i)
+    cath_chains = df[df['chain'].isin(list(chainIndexes))].drop_duplicates(subset=['chain'] + cath_columns)
+    not_in_cath = set(chainIndexes) - set(cath_chains['chain'])
+    rows = []
+    cols = []
+    for key, chains in cath_chains.groupby(by=cath_columns)['chain']:  # inverted index: classification -> chains
+        indexes = [i for chainName in chains for i in chainIndexes[chainName]]
+        rows += [indexes[0]] * (len(indexes) - 1)
+        cols += indexes[1:]
+    instrumentation.count('cath_edges', len(rows))
+    instrumentation.count('chains_not_in_cath', len(not_in_cath))
+    return rows, cols, not_in_cath
+
+
+def homologyEdges(df, nameList, seqList, columns_number, cacheFilename="identity_cache.txt", ncores=4):
+    """
+    :param df: cath data frame as it return from the func make_cath_df
+    :param nameList: list of chains
+    :param seqList: list of the chains's sequences
+    :param columns_number: the number of columns to consider with the cath classification not include the cath domain name
+    :param cacheFilename: sequence identity cache file (see identityEdges)
+    :param ncores: number of processes for the sequence alignments
+    :return: generator of the edges (i,j) of the homology graph. chains that share a CATH classification are connected
+    (see cathEdges), each chain not in CATH is connected to the following chains with sequence identity >= 0.5
+    """
     n = len(nameList)
-    mat = np.zeros((n, n))
-    for i in range(n):
-        for j in range(i + 1, n):
-            similarity = df[df['chain'].isin([nameList[i], nameList[j]])]
-            if len(similarity['chain'].unique()) == 1:
-                if (similarity['chain'].unique()[0] == nameList[i]):
-                    not_in_cath.add(nameList[j])
-                else:
-                    not_in_cath.add(nameList[i])
-            else:
-                similarity = similarity.groupby(by=cath_columns)
-                for name, group in similarity:
-                    if len(group['chain'].unique()) == 2:
-                        mat[i][j] = mat[j][i] = 1
-                        break
+    rows, cols, not_in_cath = cathEdges(df, nameList, columns_number)
+    yield from zip(rows, cols)
     # calculate the sequence identity
-    for i in range(n):
-        for j in range(i + 1, n):
-            if (nameList[i] in not_in_cath):
-                alignment = pairwise2.align.globalxx(seqList[i], seqList[j], one_alignment_only=True)
-                score = alignment[0][2] / alignment[0][4]
-                if (score >= 0.5):
-                    mat[i][j] = mat[j][i] = 1
-    return mat
+    identityRows = ((i, np.arange(i + 1, n)) for i in range(n) if nameList[i] in not_in_cath)
+    yield from identityEdges(identityRows, seqList, 0.5, cacheFilename, ncores)
+
+
+class UnionFind:
+    """
+    The homology clusters as disjoint sets of chain indexes. The edges are consumed one at a time, so the memory is
+    linear in the number of chains (no adjacency matrix is built)
+    """
+
+    def __init__(self, n):
+        """
+        :param n: number of chains
+        """
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        """
+        :param i: chain index
+        :return: the root of the cluster of chain i (with path halving)
+        """
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        """
+        :param i: chain index
+        :param j: chain index
+        merges the clusters of chains i and j (the smaller cluster goes under the root of the larger one)
+        """
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+    def addEdges(self, edges):
+        """
+        :param edges: iterable of the edges (i,j), e.g. the generator returned from homologyEdges
+        """
+        for i, j in edges:
+            self.union(i, j)
+
+    def clusters(self, *valueLists):
+        """
+        :param valueLists: lists of per chain values (e.g. sizeList, positivesList)
+        :return: tuple (relatedChainsLists, clusterSums...). relatedChainsLists[c] = sorted list of the chains of
+        cluster c, the clusters are ordered by their smallest chain index (as the connected components labels).
+        for each values list, a list of tuples (clusterIndex, sum of the values of the chains of the cluster)
+        """
+        n = len(self.parent)
+        roots = np.array([self.find(i) for i in range(n)], dtype=np.int64)
+        _, first = np.unique(roots, return_index=True)
+        labelOfRoot = np.zeros(n, dtype=np.int64)
+        labelOfRoot[roots[np.sort(first)]] = np.arange(len(first))
+        labels = labelOfRoot[roots]
+        order = np.argsort(labels, kind='stable')
+        bounds = np.cumsum(np.bincount(labels, minlength=len(first)))[:-1]
+        relatedChainsLists = [cluster.tolist() for cluster in np.split(order, bounds)] if n > 0 else []
+        sums = []
+        for values in valueLists:
+            clusterSum = np.bincount(labels, weights=values, minlength=len(first))
+            sums.append([(c, int(clusterSum[c])) for c in range(len(first))])
+        return (relatedChainsLists,) + tuple(sums)
 
 
+def karmarkarKarp(clusterSizes, k):
+    """
+    :param clusterSizes: list of tuples (clusterIndex,size)
+    :param k: number of sublists
+    :return: sublists,sublistsSum
+    multiway Karmarkar-Karp differencing: every cluster starts as a partial partition with one non empty sublist,
+    the two partial partitions with the largest spread (max sum - min sum) are merged repeatedly, pairing the largest
+    sublist of one with the smallest sublist of the other
+    """
+    heap = []
+    for count, (clusterIndex, size) in enumerate(clusterSizes):
+        sums = [size] + [0] * (k - 1)
+        heapq.heappush(heap, (-size, count, sums, [[clusterIndex]] + [[] for _ in range(k - 1)]))
+    count = len(heap)
+    if count == 0:
+        return [[] for _ in range(k)], [0] * k
+    while len(heap) > 1:
+        _, _, sums1, sublists1 = heapq.heappop(heap)
+        _, _, sums2, sublists2 = heapq.heappop(heap)
+        merged = sorted([(sums1[i] + sums2[k - 1 - i], sublists1[i] + sublists2[k - 1 - i]) for i in range(k)],
+                        key=lambda x: x[0], reverse=True)  # partial partitions are kept sorted by sum descending
+        sums = [tup[0] for tup in merged]
+        count += 1
+        heapq.heappush(heap, (sums[-1] - sums[0], count, sums, [tup[1] for tup in merged]))
+    _, _, sublistsSum, sublists = heap[0]
+    return sublists, sublistsSum
+
+
+def moveCost(sourceSum, targetSum, moved, mean):
+    """
+    :param sourceSum: sum of the sublist the clusters are moved from
+    :param targetSum: sum of the sublist the clusters are moved to
+    :param moved: numpy array of moved amounts
+    :param mean: mean sublist sum
+    :return: numpy array, the change of sum((sublistSum / mean - 1) ** 2) for every moved amount
+    """
+    before = (sourceSum / mean - 1) ** 2 + (targetSum / mean - 1) ** 2
+    return ((sourceSum - moved) / mean - 1) ** 2 + ((targetSum + moved) / mean - 1) ** 2 - before
+
 
-def createRelatedChainslist(numberOfComponents, labels):
+def swapCandidates(values, targets, window):
     """
-    :param numberOfComponents: number of component = x => 0<=label values<x
-    :param labels: labels
-    :return: RelatedChainslist: RelatedChainslist[i] = list of all the chain index's which has the label i
+    :param values: numpy array of the values of the clusters of a sublist
+    :param targets: numpy array of target values
+    :param window: number of candidates on each side of a target
+    :return: numpy array [len(targets),2*window], for each target the indexes of the clusters whose values are the
+    closest to it in sorted order (repeated at the ends)
     """
-    relatedChainsLists = [[] for _ in range(numberOfComponents)]
-    for i in range(len(labels)):
-        relatedChainsLists[labels[i]].append(i)
-    return relatedChainsLists
+    order = np.argsort(values, kind='stable')
+    position = np.searchsorted(values[order], targets)
+    return order[np.clip(position[:, None] + np.arange(-window, window), 0, len(order) - 1)]
 
 
-def createClusterSizesList(relatedChainslists, sizeList):
+def refineSublists(sublists, sizes, positives, positivesWeight, iterations, swapWindow=8):
     """
-    :param relatedChainslists:  relatedChainslist[i] = list of all the chain index's which has the label i
-    :param relatedChainslists:  sizeList- list of all the chains's size
-    :return: list of tuples (clusterIndex,size)
+    :param sublists: sublists[i] = list of the clusters in sublist i (changed in place)
+    :param sizes: dict, sizes[clusterIndex] = size of the cluster
+    :param positives: dict, positives[clusterIndex] = number of positive labels in the cluster
+    :param positivesWeight: weight of the positive labels balance in the cost
+    :param iterations: maximal number of improving moves
+    :param swapWindow: number of swap partners tried on each side of the ideal size and of the ideal positives transfer
+    (see swapCandidates)
+    local search on the cost sum((sizesSum / meanSize - 1) ** 2) + positivesWeight * sum((positivesSum / meanPositives - 1) ** 2):
+    repeatedly apply the best move of a single cluster to another sublist, or swap of two clusters between the most and
+    the least loaded sublists, while it lowers the cost. the size cost of a swap is convex in the moved size, so the
+    sizes closest to the ideal transfer contain the best size swap of every cluster; the swap partners are limited
+    to those and to the clusters closest to the ideal positives transfer, which keeps the memory linear in the
+    number of clusters
     """
-    clusterSizes = []
-    for i in range(len(relatedChainslists)):
-        my_sum = 0
-        for index in relatedChainslists[i]:
-            my_sum += sizeList[index]
-        clusterSizes.append((i, my_sum))
-    return clusterSizes
+    k = len(sublists)
+    sums = np.array([sum(sizes[c] for c in sublist) for sublist in sublists], dtype=float)
+    posSums = np.array([sum(positives[c] for c in sublist) for sublist in sublists], dtype=float)
+    mean = max(sums.mean(), 1)
+    posMean = max(posSums.mean(), 1)
+    for _ in range(iterations):
+        best = (-1e-9, None)  # (cost change, (source, target, cluster from source, cluster from target or None))
+        for a in range(k):
+            if len(sublists[a]) == 0:
+                continue
+            clusterSizes = np.array([sizes[c] for c in sublists[a]], dtype=float)
+            clusterPositives = np.array([positives[c] for c in sublists[a]], dtype=float)
+            for b in range(k):
+                if b == a:
+                    continue
+                delta = moveCost(sums[a], sums[b], clusterSizes, mean)
+                delta += positivesWeight * moveCost(posSums[a], posSums[b], clusterPositives, posMean)
+                i = int(np.argmin(delta))
+                if delta[i] < best[0]:
+                    best = (delta[i], (a, b, sublists[a][i], None))
+        a, b = int(np.argmax(sums)), int(np.argmin(sums))
+        if len(sublists[a]) > 0 and len(sublists[b]) > 0:
+            sizesA = np.array([sizes[c] for c in sublists[a]], dtype=float)
+            sizesB = np.array([sizes[d] for d in sublists[b]], dtype=float)
+            positivesA = np.array([positives[c] for c in sublists[a]], dtype=float)
+            positivesB = np.array([positives[d] for d in sublists[b]], dtype=float)
+            candidates = np.concatenate([  # [len(sublists[a]),4*swapWindow] clusters of b, linear memory
+                swapCandidates(sizesB, sizesA - (sums[a] - sums[b]) / 2, swapWindow),
+                swapCandidates(positivesB, positivesA - (posSums[a] - posSums[b]) / 2, swapWindow)], axis=1)
+            delta = moveCost(sums[a], sums[b], sizesA[:, None] - sizesB[candidates], mean)
+            delta += positivesWeight * moveCost(posSums[a], posSums[b], positivesA[:, None] - positivesB[candidates],
+                                                posMean)
+            i, column = np.unravel_index(np.argmin(delta), delta.shape)
+            if delta[i, column] < best[0]:
+                best = (delta[i, column], (a, b, sublists[a][i], sublists[b][candidates[i, column]]))
+        if best[1] is None:  # local minimum
+            break
+        a, b, c, d = best[1]
+        sublists[a].remove(c)
+        sublists[b].append(c)
+        sums[a] -= sizes[c]
+        sums[b] += sizes[c]
+        posSums[a] -= positives[c]
+        posSums[b] += positives[c]
+        if d is not None:
+            sublists[b].remove(d)
+            sublists[a].append(d)
+            sums[b] -= sizes[d]
+            sums[a] += sizes[d]
+            posSums[b] -= positives[d]
+            posSums[a] += positives[d]
 
 
-def divideClusters(clusterSizes):
+def divideClusters(clusterSizes, k=5, clusterPositives=None, positivesWeight=1.0, iterations=1000):
     """
     :param clusterSizes: list of tuples (clusterIndex,size)
+    :param k: number of sublists
+    :param clusterPositives: optional list of tuples (clusterIndex,positives), the number of positive labels of each
+    cluster. if given, the sublists are balanced by the number of positive labels as well
+    :param positivesWeight: weight of the positive labels balance relative to the sizes balance
+    :param iterations: maximal number of local search moves after the Karmarkar-Karp partition
     :return:  sublists,sublistsSum
-    divide the list into 5 sublists such that the sum of each cluster sizes in the sublist is as close as possible
-    """
-    sublists = [[] for i in range(5)]
-    sublistsSum = [0 for i in range(5)]
-    clusterSizes.sort(reverse=True, key=lambda x: x[1])  # Sort the clusters by size descending order.
-    for tup in clusterSizes:
-        min_cluster_index = sublistsSum.index(min(sublistsSum))  # find the cluster with the minimal sum
-        sublistsSum[min_cluster_index] += tup[1]
-        sublists[min_cluster_index].append(tup[0])
+    divide the list into k sublists such that the sum of each cluster sizes in the sublist is as close as possible
+    """
+    sublists, sublistsSum = karmarkarKarp(clusterSizes, k)
+    sizes = dict(clusterSizes)
+    if clusterPositives is None:
+        positives = {clusterIndex: 0 for clusterIndex in sizes}
+        positivesWeight = 0
+    else:
+        positives = dict(clusterPositives)
+    refineSublists(sublists, sizes, positives, positivesWeight, iterations)
+    sublistsSum = [sum(sizes[c] for c in sublist) for sublist in sublists]
     return sublists, sublistsSum
 
 
+def sublistsImbalance(sublistsSum):
+    """
+    :param sublistsSum: list of the sublists sums
+    :return: the largest relative deviation of a sublist sum from the mean sum (0 = perfectly balanced)
+    """
+    mean = sum(sublistsSum) / len(sublistsSum)
+    return max(abs(s - mean) for s in sublistsSum) / mean if mean > 0 else 0.0
+
+
 def clusterToChainList(clusterId, relatedChainsLists, nameList):
     """
     :param clusterId: list of chain indexs
@@ -171,59 +480,84 @@ def chainListsToChainIndexDict(chainLists):
     return chainDict
 
 
-def dividePSSM(chainDict):
+def dividePSSM(chainDict, k=5, pssmFilename="PSSM.txt", folder=None):
+    """
+    :param chainDict: chainDict[chainName] = index of chain cluster(i if chain in ChainLists[i])
+    :param k: number of sublists
+    :param pssmFilename: the PSSM file to divide
+    :param folder: directory of the fold files, None for the directory of pssmFilename
+    create k txt files. the i txt file contains the chains in chainLists[i]. only the headers are parsed, the chains
+    are copied as raw bytes runs (see label_file.write_fold_files)
+    """
+    if folder is None:
+        folder = os.path.dirname(pssmFilename)
+    names, byteOffsets = label_file.chain_index(pssmFilename)
+    folds = np.array([chainDict[name[0:4] + name[-1]] for name in names], dtype=np.int64)
+    label_file.write_fold_files(pssmFilename, byteOffsets, folds,
+                                [os.path.join(folder, "PSSM{}.txt".format(i)) for i in range(k)])
+
+
+def writeFolds(chainDict, k, labelFilename):
     """
     :param chainDict: chainDict[chainName] = index of chain cluster(i if chain in ChainLists[i])
-    create len(chainLists) txt files. the i txt file contains the chains in chainLists[i]
-    """
-    filesList = [open("PSSM{}.txt".format(i), 'w') for i in range(5)]
-    pssmFile = open("PSSM.txt", 'r')
-    lines = pssmFile.readlines()
-    fillIndex = -1  # fillIndex = i -> we now write to PSSMi.txt
-    for line in lines:
-        if line[0] == '>':  # header line
-            fillIndex = chainDict[line[1:5] + line[-2]]
-        filesList[fillIndex].write(line)
-    for i in range(5):
-        filesList[i].close()
-    pssmFile.close()
-
-
-cath_df = make_cath_df("cath-domain-list.txt", 4)
-nameList, sizeList, seqList = listCreation("PSSM.txt")
-matHomologous = neighbor_mat(cath_df, nameList, seqList, 4)
-graphHomologous = csr_matrix(matHomologous)
-homologous_components, homologousLabels = connected_components(csgraph=graphHomologous, directed=False,
-                                                            return_labels=True)
-print()
-print(nameList)
-print(sizeList)
-print(sum(sizeList))
-print(homologous_components)
-print(homologousLabels)
-print("Done2")
-relatedChainsLists = createRelatedChainslist(homologous_components, homologousLabels)
-print("Done3")
-clusterSizes = createClusterSizesList(relatedChainsLists, sizeList)
-print("Done4")
-sublists, sublistsSum = divideClusters(clusterSizes)
-print("Done5")
-
-print(relatedChainsLists)
-print(clusterSizes)
-print(sublists)
-print(sublistsSum)
-
-chainLists = sublistsToChainLists(sublists, relatedChainsLists, nameList)
-chainDict = chainListsToChainIndexDict(chainLists)
-print(chainLists)
-print(chainDict)
-dividePSSM(chainDict)
-
-
-print(relatedChainsLists)
-print(clusterSizes)
-print(sublists)
-print(sublistsSum)
+    :param k: number of sublists
+    :param labelFilename: the PSSM file to divide. a text file is divided by dividePSSM into PSSM0.txt ...,
+    a binary one gets a fold index column (label_file.write_fold_index) and is divided into PSSM0.labels ...
+    both in the directory of labelFilename
+    """
+    folder = os.path.dirname(labelFilename.rstrip('/'))
+    if not label_file.is_binary(labelFilename):
+        dividePSSM(chainDict, k, labelFilename, folder)
+        return
+    table = label_file.load_label_table(labelFilename)
+    folds = np.array([chainDict[name[0:4] + name[-1]] for name in table['names']])
+    label_file.write_fold_index(labelFilename, folds)
+    for i in range(k):
+        label_file.write_label_table(label_file.take_chains(table, np.flatnonzero(folds == i)),
+                                     os.path.join(folder, 'PSSM{}.labels'.format(i)))
+
+
+def split(config):
+    """
+    :param config: config.Config of the run
+    The function divides the chains of config.label_filename to config.folds homologous sublists, PSSM0.txt ...
+    (PSSM0.labels ... for a binary label file), written next to config.label_filename
+    """
+    instrumentation.configure_from(config)
+    with instrumentation.stage('split'):
+        with instrumentation.stage('make_cath_df'):
+            cath_df = make_cath_df(config.cath_filename, config.cath_columns)
+        folds = config.folds
+        with instrumentation.stage('listCreation'):
+            nameList, sizeList, seqList, positivesList = listCreation(config.label_filename)
+            instrumentation.count('chains', len(nameList))
+            instrumentation.count('residues', sum(sizeList))
+        with instrumentation.stage('homology'):
+            homologous = UnionFind(len(nameList))
+            homologous.addEdges(homologyEdges(cath_df, nameList, seqList, config.cath_columns,
+                                              cacheFilename=config.identity_cache, ncores=config.ncores))
+            relatedChainsLists, clusterSizes, clusterPositives = homologous.clusters(sizeList, positivesList)
+            instrumentation.count('clusters', len(relatedChainsLists))
+        with instrumentation.stage('divideClusters'):
+            sublists, sublistsSum = divideClusters(clusterSizes, k=folds, clusterPositives=clusterPositives)
+        sublistsPositives = [sum(clusterPositives[c][1] for c in sublist) for sublist in sublists]
+        print("sizes imbalance:", sublistsImbalance(sublistsSum))
+        print("positives imbalance:", sublistsImbalance(sublistsPositives))
+
+        print(relatedChainsLists)
+        print(clusterSizes)
+        print(sublists)
+        print(sublistsSum)
+
+        chainLists = sublistsToChainLists(sublists, relatedChainsLists, nameList)
+        chainDict = chainListsToChainIndexDict(chainLists)
+        print(chainLists)
+        print(chainDict)
+        with instrumentation.stage('writeFolds'):
+            writeFolds(chainDict, folds, config.label_filename)
+
 
+if __name__ == '__main__':
+    from config import Config
 
+    split(Config())
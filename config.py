@@ -0,0 +1,75 @@
+import os
+
+
+class Config:
+    """
+    The parameters of a run (labeling, fold split, training and evaluation), with the defaults of the paper runs.
+    Every parameter can be overridden by a keyword argument or from the command line (see ubiqpred.py).
+    """
+
+    defaults = {
+        # labeling (dataCreation.py)
+        'pdb_folder': 'UBDs',  # directory of the structures .cif files, named <pdb id>.cif (lower case)
+        'label_filename': 'PSSM.txt',  # the labeled chains, written by label and read by split. text (PPBS format) if
+        # the name ends with .txt, otherwise the binary format of label_file.py (e.g. PSSM.labels)
+        'shards_folder': 'PSSM_shards',  # per structure distance files, merged into the label files
+        'structure_cache': 'structure_cache',  # parsed structures records (structure_cache.py), '' to always parse
+        'thresholds': [4],  # distance cutoffs in Angstrom, label_filename is labeled with the first one and every other
+        # cutoff t gets its own label file, label_filename with a _<t>A suffix (e.g. PSSM_5A.txt)
+        'distances_filename': '',  # file for the minimum distance of every amino acid to the ubiquitin, '' for none
+        'heavy_atoms': False,  # If True, the distances ignore the hydrogen atoms.
+        'partners_filename': '',  # json file of the partner classes (see dataCreation.loadPartners), '' for ubiquitin
+        # only. with several classes, each label has one comma separated column per class
+        # fold split (cath.py)
+        'cath_filename': 'cath-domain-list.txt',
+        'cath_columns': 4,  # number of cath classification levels compared
+        'identity_cache': 'identity_cache.txt',
+        'folds': 5,
+        # incremental build (dataset_build.py)
+        'manifest_filename': 'build_manifest.json',  # state of the last build: structures hashes, graph and folds
+        # training and evaluation (transfer_learning_train.py)
+        'check': False,  # True to verify installation, False for full training.
+        'train': False,  # True to retrain, False to evaluate the model shown in paper.
+        'transfer': True,  # If False, retrain from scratch.
+        'freeze': False,  # If True, evaluate the binding site network without fine tuning.
+        'use_evolutionary': False,  # True to use evolutionary information (requires hhblits and a sequence database).
+        'Lmax_aa': None,  # maximum length of the protein sequences, None for 256 in check mode and 2120 otherwise
+        'epochs_max': None,  # None for 2 in check mode and 100 otherwise
+        'retrain_index': None,  # index of the retraining (multiple retrainings for error bars), None for a single one
+        'use_buckets': False,  # If True, chains are batched by length buckets, each padded to its own length (one
+        # model per bucket length). False keeps the paper training and evaluation, batch_size=1 at Lmax_aa
+        'bucket_lengths': None,  # padding length of each bucket, None for [128, 256, 512, 1024] (< Lmax_aa) + [Lmax_aa]
+        'token_budget': 8192,  # maximal number of padded residues in a batch, batch_size = token_budget // bucket length
+        'fold_workers': 5,  # number of folds trained/evaluated at the same time, each one in its own process
+        'prefetch_workers': 1,  # number of background processes preprocessing the next folds while a fold is
+        # evaluated (see transfer_learning_train.run_folds_prefetched), 0 to preprocess all the folds first
+        'prefetch_depth': 2,  # maximal number of folds preprocessed ahead of the fold being evaluated
+        'threads_per_worker': None,  # thread limit of each fold process, None for cpu count // fold_workers
+        'use_prediction_cache': True,  # If True, test predictions are stored per model and chain.
+        # all stages
+        'ncores': 4,  # number of worker processes (labeling, alignments, preprocessing pipeline)
+        'metrics_filename': '',  # json lines file of the stages times, peak memory and work counters (see
+        # instrumentation.py), '' to disable
+        'profile_folder': '',  # directory of the cProfile dumps of the stages, '' to disable
+    }
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: parameters to override, must be keys of Config.defaults
+        """
+        for key in kwargs:
+            if key not in self.defaults:
+                raise KeyError('Unknown parameter %s' % key)
+        for key, value in self.defaults.items():
+            setattr(self, key, kwargs.get(key, value))
+        if self.Lmax_aa is None:
+            self.Lmax_aa = 256 if self.check else 2120
+        if self.epochs_max is None:
+            self.epochs_max = 2 if self.check else 100
+        if self.bucket_lengths is None:
+            self.bucket_lengths = [L for L in [128, 256, 512, 1024] if L < self.Lmax_aa] + [self.Lmax_aa]
+        if self.threads_per_worker is None:
+            self.threads_per_worker = max(1, (os.cpu_count() or 1) // self.fold_workers)
+
+    def __repr__(self):
+        return 'Config(%s)' % ', '.join('%s=%r' % (key, getattr(self, key)) for key in self.defaults)
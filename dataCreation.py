@@ -1,6 +1,15 @@
+import contextlib
+import json
+import os
+import re
+from multiprocessing import Pool
+
 import numpy as np
-from Bio.PDB import PDBList
-from Bio.PDB.MMCIFParser import MMCIFParser
+from scipy.spatial import cKDTree
+
+import instrumentation
+import label_file
+import structure_cache
 
 # def get_alphafold_download_link(uniprot_id):
 #     link_pattern = 'https://alphafold.ebi.ac.uk/files/AF-{}-F1-model_v2.pdb'
@@ -24,7 +33,7 @@ PDB_names_list = ['1NBF', '1P3Q', '1S1Q', '1UZX', '1WR6', '1WRD', '1XD3', '1YD8'
                   '3OFI', '3OJ3', '3OLM', '3PHW', '3PRM', '3PT2', '3PTF', '3TBL', '3TMP', '3VHT']
 
 
-pdb1 = PDBList()
+# pdb1 = PDBList()
 #pdb1.download_pdb_files(pdb_codes=PDB_names_list, overwrite=True,
 #                                 pdir='C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs')
 
@@ -35,7 +44,7 @@ pdb1 = PDBList()
 #
 # fileNames = ['C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs/{}.cif'.format(PDB_names_list[i]) for i in
 #              range(len(PDB_names_list))]
-parser = MMCIFParser()  # create parser object
+# parser = MMCIFParser()  # create parser object
 
 # print("file name is", fileNames[0])
 # structures = [parser.get_structure(PDB_names_list[i], fileNames[i]) for i in range(len(PDB_names_list))]
@@ -52,51 +61,182 @@ threeLetterToSingelDict = {'GLY': 'G', 'ALA': 'A', 'VAL': 'V', 'LEU': 'L', 'ILE'
 ubiq_names = ['UBIQ_', 'RS27A_MOUSE', 'UBC_HUMAN', 'RS27A_HUMAN', 'UBB_HUMAN', 'Q5U5U6_HUMAN', 'UBI4P_YEAST',
               'UBC_HUMAN', 'P62988', 'UBB_BOVIN', 'Q24K23_BOVIN']
 
+defaultPartners = {'ubiquitin': ['ref:' + name for name in ubiq_names]}  # the partner classes of loadPartners
 
+nucleotide_names = ['A', 'C', 'G', 'U', 'I', 'DA', 'DC', 'DG', 'DT', 'DU', 'DI']  # partner residues besides amino acids
 
-spacial_cif = ['C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs/3IFW.cif', "C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs/3KVF.cif","C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs/3KW5.cif"]
-def findUbiqChains(filename):
+partner_selectors = ['ref', 'entity', 'chain', 'polymer']
+
+hydrogen_elements = ['H', 'D']  # ignored by the heavy atoms distances
+hydrogen_elements_bytes = [element.encode() for element in hydrogen_elements]
+
+cif_token = re.compile(r"'(.*?)'(?=\s|$)|\"(.*?)\"(?=\s|$)|(\S+)")  # quoted value or a bare word
+
+
+def cifTokens(file1):
     """
-    param filename: pdb file (or other format of structure)
-    return: chain ID's of the UBIQUITIN proteins
+    :param file1: opened mmCIF file
+    :return: generator of (token, is_quoted) tuples, multi-line ';' text fields are a single token
     """
-    file1 = open(filename, 'r')
-    chains = []
-    found = False
-    while True:
-        bool = True  # for the case in 3ifw that there are ubiq_ before we expect
-        line = file1.readline().split()
-        for word in line:
-            for ubiq in ubiq_names:
-                if ubiq in word:
-
-                    if filename in spacial_cif:
-                        if bool:
-                            bool = False
-                            continue
-
-                    ubiqLine = line
-                    found = True
-                    break
-            if found:
+    text_field = None
+    for line in file1:
+        if text_field is not None:
+            if line[0] == ';':  # end of the text field
+                yield "".join(text_field), True
+                text_field = None
+                line = line[1:]
+            else:
+                text_field.append(line)
+                continue
+        elif line[0] == ';':  # start of a text field
+            text_field = [line[1:]]
+            continue
+        for match in cif_token.finditer(line):
+            if match.group(3) is None:
+                yield match.group(1) if match.group(1) is not None else match.group(2), True
+            elif match.group(3)[0] == '#':  # comment until the end of the line
                 break
-        if found:
-            break
-    while True:
-        line = file1.readline().split()
-        if "loop_" == line[0]:  # start loop_ phase after UNP phase
-            break
-    line = file1.readline().split()
-    while "_struct" in line[0]:
-        line = file1.readline().split()
-    while line[0].isnumeric():
-        id = line[8]
-        if id in ubiqLine:
-            chains.append(line[3])
-        line = file1.readline().split()
+            else:
+                yield match.group(3), False
+
+
+def readCifCategories(filename, categories):
+    """
+    :param filename: mmCIF file
+    :param categories: list of category names (e.g. ['_struct_ref','_struct_ref_seq'])
+    :return: dict, data[category][item] = list of the item values (one value per row)
+    The file is streamed once and closed as soon as all the categories were read, so the coordinates
+    (_atom_site, at the end of the file) are usually never read
+    """
+    data = {}
+    with open(filename, 'r') as file1:
+        tokens = cifTokens(file1)
+        token, quoted = next(tokens, (None, False))
+        while token is not None:
+            if quoted or not (token == 'loop_' or token[0] == '_'):  # value outside of any category
+                token, quoted = next(tokens, (None, False))
+                continue
+            if len(data) == len(categories) and (token == 'loop_' or token.split('.')[0] not in categories):
+                break  # all the categories were read
+            if token == 'loop_':
+                items = []
+                token, quoted = next(tokens, (None, False))
+                while token is not None and not quoted and token[0] == '_':
+                    items.append(token)
+                    token, quoted = next(tokens, (None, False))
+                values = []
+                while token is not None and (quoted or not (token == 'loop_' or token[0] == '_')):
+                    values.append(token)
+                    token, quoted = next(tokens, (None, False))
+                category = items[0].split('.')[0]
+                if category in categories:
+                    data[category] = {item.split('.')[1]: values[k::len(items)] for k, item in enumerate(items)}
+            else:
+                category, item = token.split('.', 1)
+                value, _ = next(tokens, (None, False))
+                if category in categories:
+                    data.setdefault(category, {})[item] = [value]
+                token, quoted = next(tokens, (None, False))
+    return data
+
+
+def loadPartners(partners_filename):
+    """
+    :param partners_filename: json file of the partner classes, {"class name": [selector, ...], ...}, '' or None for
+    defaultPartners (ubiquitin only). a selector is one of:
+        ref:<name> - the chains of the _struct_ref entries whose db_code or accession contains name (e.g. ref:P62988,
+        ref:SUMO1_HUMAN)
+        entity:<id> or entity:<pdb id>/<id> - the chains of the entity, in every structure or in a single one
+        chain:<id> or chain:<pdb id>/<id> - the chain, in every structure or in a single one
+        polymer:<type> - the chains of the entities of this _entity_poly type (e.g. polymer:polydeoxyribonucleotide)
+    :return: dict, partners[class name] = list of selectors. the classes are in the order of the label columns
+    """
+    if not partners_filename:
+        return defaultPartners
+    with open(partners_filename, 'r') as partners_file:
+        partners = json.load(partners_file)
+    for selectors in partners.values():
+        for selector in selectors:
+            if selector.partition(':')[0] not in partner_selectors:
+                raise ValueError('Unknown partner selector %s, expected one of %s' % (selector, partner_selectors))
+    return partners
+
+
+def refChains(data, names):
+    """
+    :param data: categories of a mmCIF file, as returned from readCifCategories
+    :param names: list of reference identifiers (db_code or accession substrings)
+    :return: chain ID's of the _struct_ref rows whose db_code or accession matches names, taken from _struct_ref_seq
+    (or from _entity_poly if the file has no _struct_ref_seq)
+    """
+    matcher = re.compile("|".join(re.escape(name) for name in names))  # matches any of the identifiers
+    struct_ref = data.get('_struct_ref', {'id': [], 'db_code': [], 'pdbx_db_accession': [], 'entity_id': []})
+    refs = []
+    entities = []
+    for ref_id, db_code, accession, entity_id in zip(struct_ref['id'], struct_ref['db_code'],
+                                                      struct_ref['pdbx_db_accession'], struct_ref['entity_id']):
+        if matcher.search(db_code) or matcher.search(accession):
+            refs.append(ref_id)
+            entities.append(entity_id)
+    chains = []
+    if '_struct_ref_seq' in data:
+        struct_ref_seq = data['_struct_ref_seq']
+        for ref_id, chain_id in zip(struct_ref_seq['ref_id'], struct_ref_seq['pdbx_strand_id']):
+            if ref_id in refs and chain_id not in chains:
+                chains.append(chain_id)
+    elif '_entity_poly' in data:
+        entity_poly = data['_entity_poly']
+        for entity_id, chain_ids in zip(entity_poly['entity_id'], entity_poly['pdbx_strand_id']):
+            if entity_id in entities:
+                chains += [chain_id for chain_id in chain_ids.split(',') if chain_id not in chains]
     return chains
 
 
+def findPartnerChains(filename, pdb_name, partners):
+    """
+    param filename: mmCIF file of the structure
+    :param pdb_name: pdb id of the structure (for the selectors of a single structure)
+    :param partners: partner classes, as returned from loadPartners
+    return: list, partner_chains[c] = chain ID's of partner class c. the file is read once for all the classes
+    """
+    data = readCifCategories(filename, ['_entity_poly', '_struct_ref', '_struct_ref_seq'])
+    entity_poly = data.get('_entity_poly', {'entity_id': [], 'type': [], 'pdbx_strand_id': []})
+    entity_chains = {entity_id: chain_ids.split(',')
+                     for entity_id, chain_ids in zip(entity_poly['entity_id'], entity_poly['pdbx_strand_id'])}
+    partner_chains = []
+    for selectors in partners.values():
+        names = [selector.partition(':')[2] for selector in selectors if selector.partition(':')[0] == 'ref']
+        chains = refChains(data, names) if len(names) > 0 else []
+        for selector in selectors:
+            kind, _, value = selector.partition(':')
+            if '/' in value:
+                structure_name, _, value = value.partition('/')
+                if pdb_name is None or structure_name.upper() != pdb_name.upper():
+                    continue
+            if kind == 'entity':
+                selected = entity_chains.get(value, [])
+            elif kind == 'chain':
+                selected = [value]
+            elif kind == 'polymer':
+                entity_types = zip(entity_poly['entity_id'], entity_poly.get('type', []))
+                selected = [chain_id for entity_id, entity_type in entity_types if entity_type == value
+                            for chain_id in entity_chains[entity_id]]
+            else:  # ref, already selected
+                selected = []
+            chains += [chain_id for chain_id in selected if chain_id not in chains]
+        partner_chains.append(chains)
+    return partner_chains
+
+
+def findUbiqChains(filename):
+    """
+    param filename: mmCIF file of the structure
+    return: chain ID's of the UBIQUITIN proteins
+    The ubiquitin references are the _struct_ref rows whose db_code or accession matches ubiq_names (see refChains)
+    """
+    return findPartnerChains(filename, None, defaultPartners)[0]
+
+
 def atomDist(atom1, atom2):
     """
     :param atom1: atom object
@@ -139,62 +279,318 @@ def getLabelForAA(aa, ubiq_atoms, threshold):
     return 0
 
 
-def structurePPBSFormat(file1, structure, structure_filename):
+def atomsCoordinates(atoms):
+    """
+    :param atoms: list of atom objects
+    :return: numpy array [Natoms,3] of the atoms coordinates
+    """
+    coordinates = np.zeros((len(atoms), 3))
+    for i in range(len(atoms)):
+        coordinates[i] = atoms[i].get_coord()
+    return coordinates
+
+
+def getPartnerDistancesForAAs(amino_acids, partners_atoms, heavy_atoms=False):
+    """
+    :param amino_acids: list of amino acid objects
+    :param partners_atoms: list, partners_atoms[c] = the atoms of partner class c
+    :param heavy_atoms: if True, the hydrogen atoms are ignored (of both the amino acids and the partners)
+    :return: numpy array [Naa,Nclasses], distances[i,c] = minimum distance in Angstrom between an atom of
+    amino_acids[i] and an atom of partner class c (inf without atoms of class c). the atoms of the amino acids are
+    gathered once and queried against a KD-tree of each class
+    """
+    distances = np.full((len(amino_acids), len(partners_atoms)), np.inf)
+    atoms = []
+    aa_index = []  # aa_index[k] = index of the amino acid of atoms[k]
+    for i in range(len(amino_acids)):
+        aa_atoms = [atom for atom in amino_acids[i].get_atoms()
+                    if not (heavy_atoms and atom.element in hydrogen_elements)]
+        atoms += aa_atoms
+        aa_index += [i] * len(aa_atoms)
+    instrumentation.count('residues', len(amino_acids))
+    instrumentation.count('atoms', len(atoms))
+    if len(atoms) == 0:
+        return distances
+    coordinates = atomsCoordinates(atoms)
+    aa_index = np.array(aa_index)
+    for c, partner_atoms in enumerate(partners_atoms):
+        if heavy_atoms:
+            partner_atoms = [atom for atom in partner_atoms if atom.element not in hydrogen_elements]
+        instrumentation.count('partner_atoms', len(partner_atoms))
+        instrumentation.count('atom_pairs', len(coordinates) * len(partner_atoms))  # covered by the KD-tree query
+        if len(partner_atoms) == 0:
+            continue
+        dists, _ = cKDTree(atomsCoordinates(partner_atoms)).query(coordinates, k=1)
+        np.minimum.at(distances[:, c], aa_index, dists)
+    return distances
+
+
+def formatDistances(distances):
+    """
+    :param distances: numpy array of distances in Angstrom, [N] or [N,Nclasses]
+    :return: list of the distances as strings (comma separated for several classes), rounded down to 0.001 Angstrom:
+    the labels (distance < cutoff) read back from these strings are exact for any cutoff given with up to 3 decimals
+    """
+    values = np.char.mod('%.3f', np.floor(distances * 1000) / 1000)
+    if values.ndim == 2:
+        return [','.join(row) for row in values.tolist()]
+    return [str(value) for value in values]
+
+
+def partnerResidue(name):
+    """
+    :param name: residue name
+    :return: True for the residues of the partner chains whose atoms are used (amino acids and nucleotides)
+    """
+    return name in threeLetterToSingelDict or name in nucleotide_names
+
+
+def structurePPBSFormat(file1, structure, structure_filename, heavy_atoms=False, partners=None):
     """
     param filename: file to write to
     :param structure: pdb structure
     :param structure_filename:  the pdb filename of the structure
-    The function write the structure into filename in PPBS format
+    :param heavy_atoms: if True, the distances are between heavy atoms only
+    :param partners: partner classes (see loadPartners), None for defaultPartners
+    The function write the structure into filename in PPBS format, with the minimum distance of each amino acid of
+    the chains that are not partners to each partner class in place of the label (see mergeShards)
     """
     # file1 = open(filename, 'w')
-    ubiq_chains_id = findUbiqChains(structure_filename)
-    print("found chains\n", ubiq_chains_id)
-    # print(ubiq_chains_id)
+    partner_chains = findPartnerChains(structure_filename, str(structure.get_id()), partners or defaultPartners)
+    print("found chains\n", partner_chains)
+    partner_chains_id = set(chain_id for chains_id in partner_chains for chain_id in chains_id)
     chains = structure.get_chains()
-    ubiq_chains = [structure[0][id] for id in ubiq_chains_id]
-    ubiq_amino_acids = []
-    for ubiq_chain in ubiq_chains:
-        ubiq_amino_acids += aaOutOfChain(ubiq_chain)
-    ubiq_atoms = []
-    for ubiq_aa in ubiq_amino_acids:
-        ubiq_atoms += ubiq_aa.get_atoms()
-    for chain in chains:
-        if str(chain.get_id()) not in ubiq_chains_id:  # not a ubiquitin chain
-            file1.write(">" + str(structure.get_id()).lower() + "_0-" + str(chain.get_id()) + "\n")
-            chainPPBSFomrat(file1, chain, ubiq_atoms)
-
-
-def chainPPBSFomrat(file1, chain, ubiq_atoms):
+    partners_atoms = []
+    for chains_id in partner_chains:
+        partner_residues = [residue for id in chains_id if id in structure[0] for residue in structure[0][id]
+                            if partnerResidue(str(residue.get_resname()))]
+        partners_atoms.append([atom for residue in partner_residues for atom in residue.get_atoms()])
+    other_chains = [chain for chain in chains if str(chain.get_id()) not in partner_chains_id]  # not partner chains
+    chains_amino_acids = [aaOutOfChain(chain) for chain in other_chains]
+    all_amino_acids = []
+    for amino_acids in chains_amino_acids:
+        all_amino_acids += amino_acids
+    distances = getPartnerDistancesForAAs(all_amino_acids, partners_atoms, heavy_atoms)
+    distances = formatDistances(distances[:, 0] if len(partner_chains) == 1 else distances)
+    start = 0
+    for chain, amino_acids in zip(other_chains, chains_amino_acids):
+        file1.write(">" + str(structure.get_id()).lower() + "_0-" + str(chain.get_id()) + "\n")
+        chainPPBSFomrat(file1, chain, amino_acids, distances[start:start + len(amino_acids)])
+        start += len(amino_acids)
+
+
+def chainPPBSFomrat(file1, chain, amino_acids, labels):
     """
     :param file1: file to write to
     :param chain: chain structure
-    :param ubiq_atoms: list contains the ubiquitin atoms
+    :param amino_acids: list of the chain's amino acids as returned from aaOutOfChain
+    :param labels: labels[i] = label of amino_acids[i]
     The function write the chain into filename in PPBS format (Without header)
     """
-    amino_acids = aaOutOfChain(chain)
-    for aa in amino_acids:
+    for aa, label in zip(amino_acids, labels):
         name = str(aa.get_resname())
         chain_id = str(chain.get_id())
         aa_id = str(aa.get_id()[1])
         aa_type = threeLetterToSingelDict[name]
-        line = [chain_id, aa_id, aa_type]
-        threshold = 4
-        label = str(getLabelForAA(aa, ubiq_atoms, threshold))
-        line.append(label)
+        line = [chain_id, aa_id, aa_type, str(label)]
         file1.write(" ".join(line) + "\n")
 
 
-PBBS_file = open('PSSM.txt', 'a')
-structures = [parser.get_structure(PDB_names_list[i],
+def getPartnerDistancesForRecord(record, residues, partners_residues, heavy_atoms=False):
+    """
+    :param record: structure record (see structure_cache)
+    :param residues: numpy array of the indexes of the residues
+    :param partners_residues: list, partners_residues[c] = numpy array of the indexes of the residues of partner class c
+    :param heavy_atoms: if True, the hydrogen atoms are ignored
+    :return: numpy array [Nresidues,Nclasses], distances[i,c] = minimum distance in Angstrom between an atom of
+    residues[i] and an atom of partners_residues[c], inf without atoms of class c (the array version of
+    getPartnerDistancesForAAs)
+    """
+    distances = np.full((len(residues), len(partners_residues)), np.inf)
+    atoms, atom_residue = structure_cache.residueAtoms(record, residues)
+    elements = np.asarray(record['elements'])
+    if heavy_atoms:
+        heavy = ~np.isin(elements[atoms], hydrogen_elements_bytes)
+        atoms, atom_residue = atoms[heavy], atom_residue[heavy]
+    instrumentation.count('residues', len(residues))
+    instrumentation.count('atoms', len(atoms))
+    if len(atoms) == 0:
+        return distances
+    coordinates = record['coordinates']
+    query = np.asarray(coordinates[atoms], dtype=np.float64)
+    for c, partner_residues in enumerate(partners_residues):
+        partner_atoms, _ = structure_cache.residueAtoms(record, partner_residues)
+        if heavy_atoms:
+            partner_atoms = partner_atoms[~np.isin(elements[partner_atoms], hydrogen_elements_bytes)]
+        instrumentation.count('partner_atoms', len(partner_atoms))
+        instrumentation.count('atom_pairs', len(query) * len(partner_atoms))  # covered by the KD-tree query
+        if len(partner_atoms) == 0:
+            continue
+        dists, _ = cKDTree(np.asarray(coordinates[partner_atoms], dtype=np.float64)).query(query, k=1)
+        np.minimum.at(distances[:, c], atom_residue, dists)
+    return distances
+
+
+def recordPPBSFormat(file1, pdb_name, record, structure_filename, heavy_atoms=False, partners=None):
+    """
+    :param file1: file to write to
+    :param pdb_name: pdb id of the structure
+    :param record: structure record of the structure (see structure_cache)
+    :param structure_filename: the pdb filename of the structure
+    :param heavy_atoms: if True, the distances are between heavy atoms only
+    :param partners: partner classes (see loadPartners), None for defaultPartners
+    The function write the structure into file1 in PPBS format with the distances in place of the labels, as
+    structurePPBSFormat does from the Bio.PDB structure
+    """
+    partner_chains = findPartnerChains(structure_filename, pdb_name, partners or defaultPartners)
+    print("found chains\n", partner_chains)
+    chain_ids = np.asarray(record['chain_ids'])
+    is_partner_chain = np.isin(chain_ids, [chain_id for chains_id in partner_chains for chain_id in chains_id])
+    residue_chain = np.asarray(record['residue_chain'])
+    residue_names = np.asarray(record['residue_names'])
+    is_aa = np.isin(residue_names, [name.encode() for name in threeLetterToSingelDict])
+    is_partner_residue = np.isin(residue_names, [name.encode() for name in list(threeLetterToSingelDict) +
+                                                 nucleotide_names])
+    first_model = np.asarray(record['chain_models']) == 0  # the partners atoms are taken from the first model
+    partners_residues = [np.flatnonzero(is_partner_residue &
+                                        (np.isin(chain_ids, chains_id) & first_model)[residue_chain])
+                         for chains_id in partner_chains]
+    residues = np.flatnonzero(is_aa & ~is_partner_chain[residue_chain])  # not partner chains, in chain order
+    distances = getPartnerDistancesForRecord(record, residues, partners_residues, heavy_atoms)
+    distances = formatDistances(distances[:, 0] if len(partner_chains) == 1 else distances)
+    numbers = np.asarray(record['residue_numbers'])[residues]
+    letters = [threeLetterToSingelDict[name.decode()] for name in residue_names[residues]]
+    bounds = np.searchsorted(residue_chain[residues], np.arange(len(chain_ids) + 1))
+    for c in np.flatnonzero(~is_partner_chain):
+        file1.write(">" + pdb_name.lower() + "_0-" + chain_ids[c] + "\n")
+        for i in range(bounds[c], bounds[c + 1]):
+            file1.write("%s %s %s %s\n" % (chain_ids[c], numbers[i], letters[i], distances[i]))
+
+
+def structureFilename(pdb_name, pdb_folder):
+    """
+    :param pdb_name: pdb id of the structure
+    :param pdb_folder: directory of the .cif files
+    :return: the path of the structure's .cif file
+    """
+    return os.path.join(pdb_folder, '{}.cif'.format(pdb_name.lower()))
+
+
+def shardFilename(pdb_name, shards_folder):
+    """
+    :param pdb_name: pdb id of the structure
+    :param shards_folder: directory of the per structure distance files
+    :return: the path of the structure's distance file (PPBS format, distances in place of the labels)
+    """
+    return os.path.join(shards_folder, pdb_name + '_dist.txt')
+
 
-                                   r'C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs/{}.cif'.format(
+def labelFilenames(label_filename, thresholds):
+    """
+    :param label_filename: label file of thresholds[0]
+    :param thresholds: list of distance cutoffs in Angstrom
+    :return: list of the label files of the thresholds: label_filename for the first one, and label_filename with a
+    _<threshold>A suffix for the others (e.g. PSSM_5A.txt, PSSM_4.5A.labels)
+    """
+    base, extension = os.path.splitext(label_filename)
+    return [label_filename] + ['%s_%gA%s' % (base, threshold, extension) for threshold in thresholds[1:]]
+
+
+def structureToShard(task):
+    """
+    :param task: tuple (pdb_name, structure_filename, shard_filename, cache_folder, heavy_atoms, partners)
+    The function computes the distances of the amino acids of a single structure to the partner classes and writes
+    them in PPBS format into its own shard file. with a cache_folder, the structure is read from its parsed structure
+    record (see structure_cache) instead of being parsed by Bio.PDB
+    :return: shard_filename
+    """
+    pdb_name, structure_filename, shard_filename, cache_folder, heavy_atoms, partners = task
+    with instrumentation.stage('structure', pdb=pdb_name):
+        if cache_folder:
+            record = structure_cache.loadStructure(pdb_name, structure_filename, cache_folder)
+            with open(shard_filename, 'w') as shard_file:
+                recordPPBSFormat(shard_file, pdb_name, record, structure_filename, heavy_atoms, partners)
+            return shard_filename
+
+        from Bio.PDB.MMCIFParser import MMCIFParser  # imported here, importing dataCreation does not load Bio
+
+        structure = MMCIFParser(QUIET=True).get_structure(pdb_name, structure_filename)
+        instrumentation.count('structures_parsed')
+        with open(shard_filename, 'w') as shard_file:
+            structurePPBSFormat(shard_file, structure, structure_filename, heavy_atoms, partners)
+        return shard_filename
+
+
+def createPSSM(pdb_names, output_filename, shards_folder, pdb_folder, ncores=4, cache_folder=None, thresholds=(4,),
+               distances_filename=None, heavy_atoms=False, partners=None):
+    """
+    :param pdb_names: list of pdb ids
+    :param output_filename: PSSM file of thresholds[0] to write to, text (*.txt) or binary (see label_file)
+    :param shards_folder: directory for the per structure distance files
+    :param pdb_folder: directory of the .cif files
+    :param ncores: number of worker processes
+    :param cache_folder: directory of the parsed structure records (see structure_cache), None to parse every
+    structure with Bio.PDB
+    :param thresholds: distance cutoffs in Angstrom, a label file is written for each one (see labelFilenames)
+    :param distances_filename: optional file for the distances of all the amino acids (text or binary)
+    :param heavy_atoms: if True, the distances are between heavy atoms only
+    :param partners: partner classes (see loadPartners), None for defaultPartners. with several classes, the labels
+    and the distances have one comma separated column per class
+    The function computes the distances in a process pool, one structure per task (so each worker holds a single
+    parsed structure at a time), and merges the shards into the label files in the order of pdb_names
+    """
+    if not os.path.isdir(shards_folder):
+        os.mkdir(shards_folder)
+    tasks = ((pdb_name, structureFilename(pdb_name, pdb_folder), shardFilename(pdb_name, shards_folder),
+              cache_folder, heavy_atoms, partners) for pdb_name in pdb_names)
+    with instrumentation.stage('structures'), Pool(ncores) as pool:
+        shard_filenames = list(pool.imap(structureToShard, tasks))  # imap returns the shards in input order
+        instrumentation.count('structures', len(shard_filenames))
+    mergeShards(shard_filenames, labelFilenames(output_filename, thresholds), thresholds, distances_filename)
+
+
+def mergeShards(shard_filenames, label_filenames, thresholds, distances_filename=None):
+    """
+    :param shard_filenames: list of per structure distance files, in the order of the output files
+    :param label_filenames: label files to write, in the text format (*.txt) or the binary format (see label_file)
+    :param thresholds: thresholds[i] = distance cutoff in Angstrom of label_filenames[i], an amino acid is labeled 1
+    if its distance is below the cutoff (for each partner class)
+    :param distances_filename: optional file for the merged distances
+    The shards are merged one at a time, each one is thresholded and appended to every output (see
+    label_file.LabelWriter), so the memory is bounded by the largest structure
+    """
+    with instrumentation.stage('merge'), contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(label_file.LabelWriter(filename)) for filename in label_filenames]
+        distances_writer = stack.enter_context(label_file.LabelWriter(distances_filename)) if distances_filename \
+            else None
+        for shard_filename in shard_filenames:  # one structure in memory at a time
+            table = label_file.read_label_file(shard_filename, label_type=np.float64)
+            instrumentation.count('chains', len(table['names']))
+            instrumentation.count('residues', len(table['labels']))
+            distances = table['labels']
+            for writer, threshold in zip(writers, thresholds):
+                table['labels'] = (distances < threshold).astype(np.int8)
+                writer.append(table)
+            if distances_writer is not None:
+                table['labels'] = distances
+                distances_writer.append(table)
+
+def label(config):
+    """
+    :param config: config.Config of the run
+    The function labels the structures of PDB_names_list into config.label_filename, and into a label file for each
+    of the other config.thresholds
+    """
+    instrumentation.configure_from(config)
+    with instrumentation.stage('label'):
+        createPSSM(PDB_names_list, config.label_filename, config.shards_folder, config.pdb_folder,
+                   ncores=config.ncores, cache_folder=config.structure_cache, thresholds=config.thresholds,
+                   distances_filename=config.distances_filename, heavy_atoms=config.heavy_atoms,
+                   partners=loadPartners(config.partners_filename))
 
-                                       PDB_names_list[i])) for i in range(len(PDB_names_list))]
-# structure1 = parser.get_structure('1NBF', r'C:\Users\omriy\WorkshopProteins\final_project\UBIPred\UBDs\1nbf.cif')
-for i in range(len(structures)):
-    print(structures[i])
-    structurePPBSFormat(PBBS_file, structures[i],
 
-                            r'C:/Users/liory/YearC/workshop_proteins/UbiqPred/pdbs/{}.cif'.format(PDB_names_list[i]))
-PBBS_file.close()
+if __name__ == '__main__':
+    # structure1 = parser.get_structure('1NBF', r'C:\Users\omriy\WorkshopProteins\final_project\UBIPred\UBDs\1nbf.cif')
+    from config import Config
 
+    label(Config())
@@ -0,0 +1,246 @@
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+import cath
+import dataCreation
+import instrumentation
+import label_file
+from structure_cache import fileHash
+
+identityCutoff = 0.5  # as in cath.homologyEdges
+
+
+def loadManifest(manifestFilename):
+    """
+    :param manifestFilename: json file of the last build
+    :return: the manifest of the last build, an empty manifest if there was no build yet:
+        structures: list of {"name", "hash"} in the order of the chains in the PSSM file
+        heavy_atoms, partners: the heavy_atoms parameter and the partner classes the shards were computed with
+        cath: hash of the cath file and the number of cath columns the graph was built with
+        folds: number of folds
+        chains: chains[chainName] = {"sequence": sequence hash, "fold": fold index}
+        identity_edges: list of [chainName1, chainName2], the sequence identity edges of the homology graph
+    """
+    if not os.path.exists(manifestFilename):
+        return {'structures': [], 'heavy_atoms': None, 'partners': None, 'cath': None, 'folds': None, 'chains': {},
+                'identity_edges': []}
+    with open(manifestFilename, 'r') as manifestFile:
+        return json.load(manifestFile)
+
+
+def saveManifest(manifest, manifestFilename):
+    """
+    :param manifest: the manifest of the build (see loadManifest)
+    :param manifestFilename: json file to write, replaced only once the new manifest is fully written
+    """
+    with open(manifestFilename + '.tmp', 'w') as manifestFile:
+        json.dump(manifest, manifestFile)
+    os.replace(manifestFilename + '.tmp', manifestFilename)
+
+
+def structureNames(pdbFolder):
+    """
+    :param pdbFolder: directory of the .cif files
+    :return: sorted list of the pdb ids of the .cif files in pdbFolder
+    """
+    return sorted(filename[:-4].upper() for filename in os.listdir(pdbFolder) if filename.endswith('.cif'))
+
+
+def relabelStructures(pdbNames, pdbFolder, shardsFolder, ncores, cacheFolder=None, heavyAtoms=False, partners=None):
+    """
+    :param pdbNames: pdb ids of the structures to label
+    :param pdbFolder: directory of the .cif files
+    :param shardsFolder: directory of the per structure distance files (see dataCreation.structureToShard)
+    :param ncores: number of worker processes
+    :param cacheFolder: directory of the parsed structure records (see structure_cache), None to parse with Bio.PDB
+    :param heavyAtoms: if True, the distances are between heavy atoms only
+    :param partners: partner classes (see dataCreation.loadPartners), None for ubiquitin only
+    The function (re)writes the shards of pdbNames only, the shards of the other structures are kept
+    """
+    if not os.path.isdir(shardsFolder):
+        os.mkdir(shardsFolder)
+    tasks = [(pdb_name, dataCreation.structureFilename(pdb_name, pdbFolder),
+              dataCreation.shardFilename(pdb_name, shardsFolder), cacheFolder, heavyAtoms, partners)
+             for pdb_name in pdbNames]
+    if len(tasks) > 0:
+        with Pool(min(ncores, len(tasks))) as pool:
+            for _ in pool.imap_unordered(dataCreation.structureToShard, tasks):
+                pass
+
+
+def dirtyRows(dirty, nameList, not_in_cath):
+    """
+    :param dirty: indexes of the chains whose edges have to be (re)computed
+    :param nameList: list of chains (cath names)
+    :param not_in_cath: set of the chains names not found in cath
+    :return: list of tuples (i,js) of the pairs (i,j), i<j, compared by cath.homologyEdges that involve a dirty chain
+    (see cath.identityEdges): chain i is not in cath and either i or j is dirty
+    """
+    n = len(nameList)
+    dirty = np.array(sorted(dirty), dtype=np.int64)
+    isDirty = np.zeros(n, dtype=bool)
+    isDirty[dirty] = True
+    rows = []
+    for i in range(n):
+        if nameList[i] in not_in_cath:
+            js = np.arange(i + 1, n) if isDirty[i] else dirty[dirty > i]
+            if len(js) > 0:
+                rows.append((i, js))
+    return rows
+
+
+def addClusters(sublists, sums, posSums, clusters, sizes, positives, positivesWeight=1.0):
+    """
+    :param sublists: the folds, lists of cluster indexes (updated in place)
+    :param sums: numpy array of the folds sizes (updated in place)
+    :param posSums: numpy array of the folds number of positive labels (updated in place)
+    :param clusters: indexes of the clusters to add
+    :param sizes: sizes[c] = size of cluster c
+    :param positives: positives[c] = number of positive labels of cluster c
+    :param positivesWeight: weight of the positive labels balance relative to the sizes balance
+    Every cluster, largest first, goes to the fold where it increases the imbalance the least
+    (the same cost as cath.refineSublists, measured against the final mean fold size)
+    """
+    k = len(sublists)
+    mean = max((sums.sum() + sum(sizes[c] for c in clusters)) / k, 1)
+    posMean = max((posSums.sum() + sum(positives[c] for c in clusters)) / k, 1)
+    for c in sorted(clusters, key=lambda c: sizes[c], reverse=True):
+        cost = ((sums + sizes[c]) / mean - 1) ** 2 - (sums / mean - 1) ** 2
+        cost += positivesWeight * (((posSums + positives[c]) / posMean - 1) ** 2 - (posSums / posMean - 1) ** 2)
+        target = int(np.argmin(cost))
+        sublists[target].append(c)
+        sums[target] += sizes[c]
+        posSums[target] += positives[c]
+
+
+def assignFolds(relatedChainsLists, headers, clusterSizes, clusterPositives, previousFolds, k):
+    """
+    :param relatedChainsLists: relatedChainsLists[c] = indexes of the chains of cluster c
+    :param headers: chains headers (the keys of previousFolds)
+    :param clusterSizes: list of tuples (clusterIndex,size)
+    :param clusterPositives: list of tuples (clusterIndex,positives)
+    :param previousFolds: previousFolds[header] = fold of the chain in the last build
+    :param k: number of folds
+    :return: tuple (sublists, numberOfAffected). A cluster whose chains were all in the same fold keeps it, the other
+    (affected) clusters are added to the folds by addClusters. Without any kept cluster, all the clusters are divided by
+    cath.divideClusters, as in a full split
+    """
+    sublists = [[] for _ in range(k)]
+    affected = []
+    for c, cluster in enumerate(relatedChainsLists):
+        folds = set(previousFolds.get(headers[i]) for i in cluster)
+        if len(folds) == 1 and None not in folds:
+            sublists[folds.pop()].append(c)
+        else:
+            affected.append(c)
+    if len(affected) == len(relatedChainsLists):
+        sublists, _ = cath.divideClusters(clusterSizes, k=k, clusterPositives=clusterPositives)
+        return sublists, len(affected)
+    sizes = dict(clusterSizes)
+    positives = dict(clusterPositives)
+    sums = np.array([sum(sizes[c] for c in sublist) for sublist in sublists], dtype=float)
+    posSums = np.array([sum(positives[c] for c in sublist) for sublist in sublists], dtype=float)
+    addClusters(sublists, sums, posSums, affected, sizes, positives)
+    return sublists, len(affected)
+
+
+def build(config):
+    """
+    :param config: config.Config of the run
+    Incremental version of label + split: only the new or changed .cif files of config.pdb_folder are relabeled,
+    only the sequence identities of their chains are computed and only the clusters they affect are (re)assigned to
+    folds. The state of the build is kept in config.manifest_filename.
+    """
+    instrumentation.configure_from(config)
+    with instrumentation.stage('build'):
+        manifest = loadManifest(config.manifest_filename)
+
+        # %% Relabel the new and changed structures.
+        hashes = {pdb_name: fileHash(dataCreation.structureFilename(pdb_name, config.pdb_folder))
+                  for pdb_name in structureNames(config.pdb_folder)}
+        previousHashes = {structure['name']: structure['hash'] for structure in manifest['structures']}
+        order = [structure['name'] for structure in manifest['structures'] if structure['name'] in hashes]
+        order += [pdb_name for pdb_name in sorted(hashes) if pdb_name not in previousHashes]  # new ones at the end
+        partners = dataCreation.loadPartners(config.partners_filename)
+        relabelAll = (manifest.get('heavy_atoms') != config.heavy_atoms or  # other distances, relabel everything
+                      manifest.get('partners') != partners)
+        changed = [pdb_name for pdb_name in order
+                   if relabelAll or previousHashes.get(pdb_name) != hashes[pdb_name] or
+                   not os.path.exists(dataCreation.shardFilename(pdb_name, config.shards_folder))]
+        print('%s structures, %s new or changed, %s removed' % (
+            len(order), len(changed), len(set(previousHashes) - set(hashes))))
+        with instrumentation.stage('relabel'):
+            relabelStructures(changed, config.pdb_folder, config.shards_folder, config.ncores,
+                              config.structure_cache, config.heavy_atoms, partners)
+            instrumentation.count('structures', len(order))
+            instrumentation.count('structures_relabeled', len(changed))
+        dataCreation.mergeShards([dataCreation.shardFilename(pdb_name, config.shards_folder) for pdb_name in order],
+                                 dataCreation.labelFilenames(config.label_filename, config.thresholds),
+                                 config.thresholds, config.distances_filename)
+
+        # %% Update the homology graph.
+        with instrumentation.stage('homology'):
+            headers = [str(name) for name in label_file.read_labels(config.label_filename)['names']]
+            nameList, sizeList, seqList, positivesList = cath.listCreation(config.label_filename)
+            n = len(headers)
+            sequenceHashes = [cath.sequenceHash(seq) for seq in seqList]
+            cathTag = '%s %s' % (fileHash(config.cath_filename), config.cath_columns)
+            previousChains = manifest['chains'] if manifest['cath'] == cathTag else {}  # a new cath file, new graph
+            dirty = [i for i in range(n) if previousChains.get(headers[i], {}).get('sequence') != sequenceHashes[i]]
+            dirtyHeaders = set(headers[i] for i in dirty)
+            headerIndexes = {header: i for i, header in enumerate(headers)}
+            identityEdges = [(headerIndexes[a], headerIndexes[b]) for a, b in manifest['identity_edges']
+                             if previousChains and a in headerIndexes and b in headerIndexes and
+                             a not in dirtyHeaders and b not in dirtyHeaders]
+            rows, cols, not_in_cath = cath.cathEdges(cath.make_cath_df(config.cath_filename, config.cath_columns),
+                                                     nameList, config.cath_columns)
+            identityRows = dirtyRows(dirty, nameList, not_in_cath)
+            print('%s new or changed chains, %s sequence pairs to compare' % (
+                len(dirty), sum(len(js) for _, js in identityRows)))
+            identityEdges += cath.identityEdges(identityRows, seqList, identityCutoff, config.identity_cache,
+                                                config.ncores)
+            homologous = cath.UnionFind(n)
+            homologous.addEdges(zip(rows, cols))
+            homologous.addEdges(identityEdges)
+            relatedChainsLists, clusterSizes, clusterPositives = homologous.clusters(sizeList, positivesList)
+            instrumentation.count('chains', n)
+            instrumentation.count('chains_changed', len(dirty))
+            instrumentation.count('clusters', len(relatedChainsLists))
+
+        # %% Reassign the affected clusters to folds.
+        with instrumentation.stage('assignFolds'):
+            previousFolds = {}
+            if manifest['folds'] == config.folds:
+                previousFolds = {header: chain['fold'] for header, chain in manifest['chains'].items()}
+            sublists, numberOfAffected = assignFolds(relatedChainsLists, headers, clusterSizes, clusterPositives,
+                                                     previousFolds, config.folds)
+            print('%s clusters, %s (re)assigned to folds' % (len(relatedChainsLists), numberOfAffected))
+            sublistsSum = [sum(sizeList[i] for c in sublist for i in relatedChainsLists[c]) for sublist in sublists]
+            print("sizes imbalance:", cath.sublistsImbalance(sublistsSum))
+            chainLists = cath.sublistsToChainLists(sublists, relatedChainsLists, nameList)
+            cath.writeFolds(cath.chainListsToChainIndexDict(chainLists), config.folds, config.label_filename)
+            instrumentation.count('clusters_reassigned', numberOfAffected)
+
+        folds = {}
+        for fold, sublist in enumerate(sublists):
+            for c in sublist:
+                for i in relatedChainsLists[c]:
+                    folds[headers[i]] = fold
+        saveManifest({
+            'structures': [{'name': pdb_name, 'hash': hashes[pdb_name]} for pdb_name in order],
+            'heavy_atoms': config.heavy_atoms,
+            'partners': partners,
+            'cath': cathTag,
+            'folds': config.folds,
+            'chains': {headers[i]: {'sequence': sequenceHashes[i], 'fold': folds[headers[i]]} for i in range(n)},
+            'identity_edges': [[headers[i], headers[j]] for i, j in identityEdges],
+        }, config.manifest_filename)
+
+
+if __name__ == '__main__':
+    from config import Config
+
+    build(Config())
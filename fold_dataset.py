@@ -0,0 +1,75 @@
+import numpy as np
+
+
+def as_chain_array(array):
+    """
+    :param array: per chain array, either an object array of chains or a numeric array whose first axis is the chain
+    :return: 1D object array, element i is chain i of array (a view, the chain data is not copied)
+    """
+    if isinstance(array, np.ndarray) and array.dtype == object and array.ndim == 1:
+        return array
+    chains = np.empty(len(array), dtype=object)
+    for i in range(len(array)):
+        chains[i] = array[i]
+    return chains
+
+
+class FoldDataset:
+    """
+    The processed cross-validation folds, each kept once in memory.
+    The train and test sets of a fold are built by gathering references to the chains of the other folds,
+    so no per fold copy of the inputs is materialized (only arrays of pointers, one per chain).
+    Folds may be added out of order or not at all (e.g. only the test fold of an evaluation), a missing fold is None.
+    """
+
+    def __init__(self):
+        self.inputs = []  # inputs[fold][j] = object array of the chains of input j
+        self.outputs = []  # outputs[fold] = object array of the chains labels
+        self.weights = []  # weights[fold] = numpy array of the chain-wise weights
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def add_fold(self, inputs, outputs, weights, fold=None):
+        """
+        :param inputs: list of the inputs of the fold (as returned from pipeline.build_processed_dataset)
+        :param outputs: labels of the fold
+        :param weights: chain-wise weights of the fold
+        :param fold: index of the fold, None for the next one
+        """
+        if fold is None:
+            fold = len(self)
+        while len(self) <= fold:
+            self.inputs.append(None)
+            self.outputs.append(None)
+            self.weights.append(None)
+        self.inputs[fold] = [as_chain_array(input_) for input_ in inputs]
+        self.outputs[fold] = as_chain_array(outputs)
+        self.weights[fold] = np.asarray(weights)
+
+    def fold_sizes(self):
+        """
+        :return: list, the number of chains of every fold (0 for the missing folds)
+        """
+        return [0 if weights is None else len(weights) for weights in self.weights]
+
+    def subset(self, folds):
+        """
+        :param folds: list of fold indexes
+        :return: tuple (inputs, outputs, weights) of the chains of folds, in the order of folds
+        """
+        if len(folds) == 1:  # the fold itself, no gathering needed
+            return self.inputs[folds[0]], self.outputs[folds[0]], self.weights[folds[0]]
+        inputs = [np.concatenate([self.inputs[fold][j] for fold in folds]) for j in range(len(self.inputs[0]))]
+        outputs = np.concatenate([self.outputs[fold] for fold in folds])
+        weights = np.concatenate([self.weights[fold] for fold in folds])
+        return inputs, outputs, weights
+
+    def split(self, k):
+        """
+        :param k: index of the test fold
+        :return: tuple (train, test), each one a tuple (inputs, outputs, weights).
+        train = all the folds except k, test = fold k
+        """
+        not_k = [i for i in range(len(self)) if i != k]
+        return self.subset(not_k), self.subset([k])
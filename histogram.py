@@ -1,31 +1,33 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
+
+import instrumentation
+
+
+def flatten_chains(chains, ndim):
+    """
+    :params chains: list of per chain arrays (predictions [Naa] or labels [Naa,2]), or an already concatenated array
+    :params ndim: number of dimensions of the concatenated array (1 for predictions, 2 for labels)
+    :return: numpy array of all the chains concatenated along the residues axis
+    """
+    if isinstance(chains, np.ndarray) and chains.dtype != object and chains.ndim == ndim:
+        return chains
+    if len(chains) == 0:
+        return np.zeros((0,) + (2,) * (ndim - 1))
+    return np.concatenate([np.asarray(chain) for chain in chains])
 
 
 def create_label_lists(all_cross_test_label, all_cross_predictions):
     """
     :params all_cross_predictions: list of lists, in each list there are predictions (probabillities)
     :params all_cross_test_label: list of lists , in each list the labels of the according queries (hot one encoded as [Naa,2]
-    :return tuple (label0_list,label1_list)
+    both can also be given already concatenated, as a [N,2] labels array and a [N] predictions array
+    :return tuple (label0_list,label1_list) of numpy arrays
     """
-    label0_list = []
-    label1_list = []
-    label0 = np.array([1, 0])
-    label1 = np.array([0, 1])
-    # print(label0)
-    # print(all_cross_test_label[0][0])
-    # print(np.all(label0,all_cross_test_label[0][0]))
-    for i in range(len(all_cross_test_label)):
-        for j in range(len(all_cross_test_label[i])):
-            label = all_cross_test_label[i][j]
-            if np.all(label == label0):  # label = 0
-                label0_list.append(all_cross_predictions[i][j])
-            elif np.all(label == label1):  # label = 1
-                label1_list.append(all_cross_predictions[i][j])
-            else:  # non valid query
-                continue
-    return label0_list, label1_list
+    labels = flatten_chains(all_cross_test_label, 2)
+    predictions = flatten_chains(all_cross_predictions, 1)
+    is_label0 = (labels[:, 0] == 1) & (labels[:, 1] == 0)
+    is_label1 = (labels[:, 0] == 0) & (labels[:, 1] == 1)  # other rows (e.g [0,0]) are non valid queries
+    return predictions[is_label0], predictions[is_label1]
 
 
 def create_labels_histogram(label0_list, label1_list):
@@ -34,6 +36,9 @@ def create_labels_histogram(label0_list, label1_list):
     :params label1_list: list of the predictions with label = 1
     The function plots histogram of the labels distribution
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     label0_list = np.array(label0_list)
     label1_list = np.array(label1_list)
     sns.kdeplot(data=label0_list, label="non UBD's")
@@ -56,27 +61,49 @@ def create_labels_histogram(label0_list, label1_list):
 #     return np.percentile(predictions, percentile)
 #
 
-def find_threshold(precision, label0_list, label1_list, all_predictions):
+def find_thresholds(label0_list, label1_list, precisions=(), recalls=(), weights0=None, weights1=None):
     """
-    :params: precision: value of precision to make
     :params label0_list: list of the predictions with label = 0
     :params label1_list: list of the predictions with label = 1
-    The function returning the threshold needed to achieve precision
+    :params precisions: list of target precisions
+    :params recalls: list of target recalls
+    :params weights0: optional sample weights of label0_list (default 1)
+    :params weights1: optional sample weights of label1_list (default 1)
+    :return: tuple (precision_thresholds, recall_thresholds) of numpy arrays
+    precision_thresholds[i] = the lowest prediction t such that the precision of (predictions > t) is above precisions[i]
+    recall_thresholds[i] = the highest prediction t such that the recall of (predictions > t) is at least recalls[i]
+    nan if the target can not be achieved. the predictions are sorted once and the number of label 0/1 predictions
+    above each threshold are cumulative sums, so all the targets cost O(N log N)
     """
-    # all_predictions = np.concatenate(np.array([np.array(label0_list), np.array(label1_list)]))
-    # all_predictions = np.sort(all_predictions)
-    print(len(all_predictions))
-    for i in range(len(all_predictions)):
-        threshold = all_predictions[i]
-        mask0 = label0_list > threshold
-        num_0_elements = np.sum(mask0)
-        mask1 = label1_list > threshold
-        num_1_elements = np.sum(mask1)
-        calculated_precision = (num_1_elements) / (num_0_elements + num_1_elements)
-        if calculated_precision > precision:
-            print("num1_elements :", num_1_elements)
-            print("num0_elements :", num_0_elements)
-            return threshold
+    instrumentation.count('residues_evaluated', len(label0_list) + len(label1_list))
+    label0_list = np.ravel(label0_list).astype(float)
+    label1_list = np.ravel(label1_list).astype(float)
+    weights0 = np.ones(len(label0_list)) if weights0 is None else np.ravel(weights0).astype(float)
+    weights1 = np.ones(len(label1_list)) if weights1 is None else np.ravel(weights1).astype(float)
+    predictions = np.concatenate([label0_list, label1_list])
+    order = np.argsort(predictions, kind='stable')
+    predictions = predictions[order]
+    weights_1 = np.concatenate([np.zeros(len(label0_list)), weights1])[order]
+    weights_0 = np.concatenate([weights0, np.zeros(len(label1_list))])[order]
+    thresholds, first = np.unique(predictions, return_index=True)
+    last = np.append(first[1:], len(predictions)) - 1  # last index of every threshold in the sorted predictions
+    num_1_above = weights_1.sum() - np.cumsum(weights_1)[last]  # weight of label 1 predictions > threshold
+    num_0_above = weights_0.sum() - np.cumsum(weights_0)[last]
+    num_above = num_0_above + num_1_above
+    calculated_precision = np.divide(num_1_above, num_above, out=np.zeros(len(thresholds)), where=num_above > 0)
+    calculated_recall = num_1_above / max(weights_1.sum(), 1e-12)
+
+    precision_thresholds = np.full(len(precisions), np.nan)
+    for i in range(len(precisions)):
+        achieved = np.flatnonzero(calculated_precision > precisions[i])
+        if len(achieved) > 0:
+            precision_thresholds[i] = thresholds[achieved[0]]
+    recall_thresholds = np.full(len(recalls), np.nan)
+    for i in range(len(recalls)):
+        achieved = np.flatnonzero(calculated_recall >= recalls[i])  # recall decreases with the threshold
+        if len(achieved) > 0:
+            recall_thresholds[i] = thresholds[achieved[-1]]
+    return precision_thresholds, recall_thresholds
 
 
 # list1 = [[0, 1], [0, 1], [1, 0], [0, 1], [0, 0], [1, 0]]
@@ -97,3 +124,155 @@ def find_threshold(precision, label0_list, label1_list, all_predictions):
 #
 # label0_list, label1_list = create_label_lists(list1, list2)
 # create_labels_histogram(label0_list, label1_list)
+
+
+class MetricsAccumulator:
+    """
+    Binned histograms of the predictions of each label, updated fold by fold during the cross-validation.
+    The PR/ROC curves, AUCs, thresholds and the histogram plot are computed from the bin counts only,
+    so the predictions of a fold can be dropped right after update.
+    Thresholds are bin edges, i.e. their resolution is 1 / bins.
+    """
+
+    def __init__(self, bins=1000):
+        """
+        :params bins: number of bins of the [0,1] predictions range
+        """
+        self.bins = bins
+        self.edges = np.linspace(0, 1, bins + 1)
+        self.fold_counts = {}  # fold_counts[fold] = [counts0, counts1], the weight of label 0/1 predictions per bin
+
+    def update(self, test_labels, test_predictions, weights=None, fold=0):
+        """
+        :params test_labels: list of per chain labels one-hot encoded as [Naa,2] (or a concatenated [N,2] array)
+        :params test_predictions: list of per chain predictions [Naa] (or a concatenated [N] array)
+        :params weights: optional chain-wise weights, used only with per chain lists
+        :params fold: fold of the predictions, for the per fold breakdowns
+        """
+        residue_weights = None
+        if not isinstance(test_predictions, np.ndarray) or test_predictions.dtype == object:
+            lengths = [len(prediction) for prediction in test_predictions]
+            test_labels = [np.asarray(label)[:length] for label, length in zip(test_labels, lengths)]  # truncated at Lmax
+            if weights is not None:
+                residue_weights = np.repeat(np.asarray(weights, dtype=float), lengths)
+        labels = flatten_chains(test_labels, 2)
+        predictions = flatten_chains(test_predictions, 1)
+        if residue_weights is None:
+            residue_weights = np.ones(len(predictions))
+        instrumentation.count('residues_evaluated', len(predictions))
+        bin_index = np.clip((predictions * self.bins).astype(int), 0, self.bins - 1)
+        counts = self.fold_counts.setdefault(fold, [np.zeros(self.bins), np.zeros(self.bins)])
+        for label, label_counts in zip([0, 1], counts):
+            mask = (labels[:, label] == 1) & (labels[:, 1 - label] == 0)
+            label_counts += np.bincount(bin_index[mask], weights=residue_weights[mask], minlength=self.bins)
+
+    def counts(self, fold=None):
+        """
+        :params fold: fold to take, None for all the folds
+        :return: tuple (counts0, counts1)
+        """
+        if fold is not None:
+            return self.fold_counts[fold]
+        counts0 = sum(counts[0] for counts in self.fold_counts.values())
+        counts1 = sum(counts[1] for counts in self.fold_counts.values())
+        return counts0, counts1
+
+    def cumulative_counts(self, fold=None):
+        """
+        :return: tuple (num_0_above, num_1_above), weight of the predictions >= edges[b] for every bin b
+        """
+        counts0, counts1 = self.counts(fold)
+        return np.cumsum(counts0[::-1])[::-1], np.cumsum(counts1[::-1])[::-1]
+
+    def pr_curve(self, fold=None):
+        """
+        :return: tuple (precision, recall, thresholds), the point of index b is the prediction >= thresholds[b]
+        """
+        num_0_above, num_1_above = self.cumulative_counts(fold)
+        num_above = num_0_above + num_1_above
+        precision = np.divide(num_1_above, num_above, out=np.ones(self.bins), where=num_above > 0)
+        recall = num_1_above / max(num_1_above[0], 1e-12)
+        return precision, recall, self.edges[:-1]
+
+    def roc_curve(self, fold=None):
+        """
+        :return: tuple (false_positive_rate, true_positive_rate, thresholds)
+        """
+        num_0_above, num_1_above = self.cumulative_counts(fold)
+        return num_0_above / max(num_0_above[0], 1e-12), num_1_above / max(num_1_above[0], 1e-12), self.edges[:-1]
+
+    def auc_pr(self, fold=None):
+        """
+        :return: area under the PR curve (average precision: sum of precision * recall increment)
+        """
+        precision, recall, _ = self.pr_curve(fold)
+        return np.sum(precision * (recall - np.append(recall[1:], 0)))
+
+    def auc_roc(self, fold=None):
+        """
+        :return: area under the ROC curve
+        """
+        false_positive_rate, true_positive_rate, _ = self.roc_curve(fold)
+        false_positive_rate = np.append(false_positive_rate, 0)
+        true_positive_rate = np.append(true_positive_rate, 0)
+        return np.sum((false_positive_rate[:-1] - false_positive_rate[1:]) *
+                      (true_positive_rate[:-1] + true_positive_rate[1:]) / 2)
+
+    def thresholds(self, precisions=(), recalls=(), fold=None):
+        """
+        :params precisions: list of target precisions
+        :params recalls: list of target recalls
+        :return: tuple (precision_thresholds, recall_thresholds) as in find_thresholds, at the bins resolution
+        """
+        precision, recall, edges = self.pr_curve(fold)
+        num_0_above, num_1_above = self.cumulative_counts(fold)
+        valid = (num_0_above + num_1_above) > 0
+        precision_thresholds = np.full(len(precisions), np.nan)
+        for i in range(len(precisions)):
+            achieved = np.flatnonzero(valid & (precision > precisions[i]))
+            if len(achieved) > 0:
+                precision_thresholds[i] = edges[achieved[0]]
+        recall_thresholds = np.full(len(recalls), np.nan)
+        for i in range(len(recalls)):
+            achieved = np.flatnonzero(recall >= recalls[i])
+            if len(achieved) > 0:
+                recall_thresholds[i] = edges[achieved[-1]]
+        return precision_thresholds, recall_thresholds
+
+    def plot_histograms(self, fold=None):
+        """
+        The function plots the normalized histograms of the predictions of each label
+        (the binned version of create_labels_histogram)
+        """
+        import matplotlib.pyplot as plt
+
+        counts0, counts1 = self.counts(fold)
+        width = 1 / self.bins
+        plt.stairs(counts0 / max(counts0.sum() * width, 1e-12), self.edges, label="non UBD's")
+        plt.stairs(counts1 / max(counts1.sum() * width, 1e-12), self.edges, label="UBD's")
+        plt.xlabel("binding probability")
+        plt.legend()
+        plt.show()
+
+    def plot_pr_curves(self, title='', figsize=(10, 10), fs=25):
+        """
+        :return: tuple (fig, ax), the PR curve of all the folds together and of every fold
+        """
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(figsize=figsize)
+        for fold in sorted(self.fold_counts):
+            precision, recall, _ = self.pr_curve(fold)
+            ax.plot(recall, precision, linewidth=1, alpha=0.5,
+                    label='Fold %s (AUCPR= %.3f)' % (fold + 1, self.auc_pr(fold)))
+        precision, recall, _ = self.pr_curve()
+        ax.plot(recall, precision, linewidth=2.0, color='black',
+                label='Cross-validation (AUCPR= %.3f)' % self.auc_pr())
+        ax.set_xlim([0, 1])
+        ax.set_ylim([0, 1])
+        ax.grid(True)
+        ax.set_xlabel('Recall', fontsize=fs)
+        ax.set_ylabel('Precision', fontsize=fs)
+        ax.set_title(title, fontsize=fs)
+        ax.legend(fontsize=fs * 0.6)
+        return fig, ax
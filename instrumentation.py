@@ -0,0 +1,145 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource  # not available on Windows, the peak RSS is then not reported
+except ImportError:
+    resource = None
+
+'''
+Stage-level instrumentation of the pipeline. A stage is a block of code measured by
+
+    with instrumentation.stage('homology'):
+        ...
+        instrumentation.count('pairs_aligned', len(pairs))
+
+Each stage, once finished, is written as a json line to the metrics file:
+    stage: path of the stage ('split/homology' for a stage inside the split stage), pid
+    wall_s, cpu_s: wall and CPU time of the process; children_cpu_s: CPU time of the finished child processes (pools)
+    peak_rss_mb, children_peak_rss_mb: peak resident memory of the process and of its largest child so far
+    counters: the work counters of the stage (count adds to the innermost running stage)
+    and the keyword arguments of the stage (e.g. pdb, fold).
+Forked worker processes append their own stages to the same file. With a profile folder, the outermost profiled
+stage of each process is also profiled by cProfile and dumped as <stage>-<pid>-<n>.prof (pstats format, for snakeviz,
+gprof2dot or python -m pstats); a forked worker stops the profiler inherited from its parent and profiles its own
+stages. Without a metrics file and a profile folder, stage and count do nothing.
+'''
+
+settings = {'metrics_filename': None, 'profile_folder': None}
+active_stages = []  # the running stages of this process, innermost last
+profile_dumps = [0]  # number of profiles dumped by this process
+running_profiler = {'profiler': None, 'pid': None}  # the profiler of the outermost profiled stage and its process
+
+
+def configure(metrics_filename=None, profile_folder=None):
+    """
+    :param metrics_filename: json lines file the stages are appended to, None or '' to disable
+    :param profile_folder: directory of the cProfile dumps, None or '' to disable
+    """
+    settings['metrics_filename'] = metrics_filename or None
+    settings['profile_folder'] = profile_folder or None
+    if settings['profile_folder'] is not None:
+        os.makedirs(settings['profile_folder'], exist_ok=True)
+
+
+def configure_from(config):
+    """
+    :param config: config.Config of the run, its metrics_filename and profile_folder are used
+    """
+    configure(config.metrics_filename, config.profile_folder)
+
+
+def enabled():
+    """
+    :return: True if the stages are measured
+    """
+    return settings['metrics_filename'] is not None or settings['profile_folder'] is not None
+
+
+def peak_rss_mb(children=False):
+    """
+    :param children: if True, the peak of the largest finished child process instead of this process
+    :return: peak resident memory in MB, None if it is not available on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KB on Linux
+
+
+def children_cpu_time():
+    """
+    :return: user + system CPU time in seconds of the finished child processes
+    """
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def count(name, n=1):
+    """
+    :param name: counter name
+    :param n: amount to add to the counter of the innermost running stage (nothing outside of a stage)
+    """
+    if len(active_stages) > 0:
+        counters = active_stages[-1]['counters']
+        counters[name] = counters.get(name, 0) + n
+
+
+def write_record(record):
+    """
+    :param record: finished stage, appended as a json line to the metrics file
+    """
+    with open(settings['metrics_filename'], 'a') as metrics_file:
+        metrics_file.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    :param name: stage name
+    :param fields: json serializable values added to the stage record
+    Measures the enclosed block, see above
+    """
+    if not enabled():
+        yield
+        return
+    record = {'stage': '/'.join([parent['stage'] for parent in active_stages[-1:]] + [name]), 'pid': os.getpid()}
+    record.update(fields)
+    record['counters'] = {}
+    profiler = None
+    if running_profiler['profiler'] is not None and running_profiler['pid'] != os.getpid():
+        running_profiler['profiler'].disable()  # inherited from the parent by a forked worker, never dumped
+        running_profiler['profiler'] = None
+    if settings['profile_folder'] is not None and running_profiler['profiler'] is None:
+        profiler = cProfile.Profile()
+        running_profiler['profiler'], running_profiler['pid'] = profiler, os.getpid()
+    active_stages.append(record)
+    start_wall, start_cpu, start_children = time.perf_counter(), time.process_time(), children_cpu_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    except BaseException as exception:
+        record['error'] = type(exception).__name__
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            running_profiler['profiler'] = None
+        record['wall_s'] = time.perf_counter() - start_wall
+        record['cpu_s'] = time.process_time() - start_cpu
+        record['children_cpu_s'] = children_cpu_time() - start_children
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['children_peak_rss_mb'] = peak_rss_mb(children=True)
+        active_stages.pop()
+        record['counters'] = record.pop('counters')  # last, after the measures
+        if settings['metrics_filename'] is not None:
+            write_record(record)
+        if profiler is not None:
+            profile_dumps[0] += 1
+            profiler.dump_stats(os.path.join(settings['profile_folder'], '%s-%s-%s.prof' % (
+                record['stage'].replace('/', '_'), record['pid'], profile_dumps[0])))
@@ -0,0 +1,480 @@
+import os
+import shutil
+
+import numpy as np
+
+
+def parse_labels(labels, label_type):
+    """
+    :param labels: list of the labels words (bytes)
+    :param label_type: numpy type of the labels
+    :return: numpy array of label_type, [N] or [N,Nclasses] for comma separated labels
+    """
+    digits = b''.join(labels)
+    if b',' in digits:  # multi-column labels
+        return np.array([label.split(b',') for label in labels]).astype(label_type)
+    elif np.issubdtype(label_type, np.integer) and len(digits) == len(labels):  # single digits, no need to parse
+        return (np.frombuffer(digits, dtype=np.uint8) - ord('0')).astype(label_type)
+    return np.array(labels).astype(label_type)
+
+
+def read_label_file(filename, chunk_size=1 << 20, label_type=np.int8):
+    """
+    :param filename: label file in PPBS format, a ">name" header line for each chain followed by one
+    "chain_id resid aa label" line for each residue (PSSM.txt, datasets/*/labels_*.txt)
+    :param chunk_size: number of bytes read at once, the file is streamed in chunks cut at chain boundaries and each
+    chunk is converted to arrays before the next one is read
+    :param label_type: numpy type of the labels column, e.g. np.float32 for the distance files of dataCreation. a
+    label may also be a comma separated list of values, one per partner class (see dataCreation.loadPartners)
+    :return: dict of columnar arrays, read in a single pass over the file:
+        names: list of the chains's names (header without '>')
+        offsets: numpy int64 array [Nchains+1], the residues of chain i are offsets[i]:offsets[i+1]
+        chain_ids: numpy bytes array [Nresidues] of the residues chain ids, as wide as the longest one
+        resids: numpy bytes array [Nresidues] of the residues ids (with insertion code), as wide as the longest one
+        sequence: numpy uint8 array [Nresidues] of the amino acids one letter codes
+        labels: numpy array of label_type, [Nresidues] or [Nresidues,Nclasses] for comma separated labels
+    """
+    names = []
+    sizes = [0]
+    chain_ids = []  # one array per chunk
+    resids = []
+    sequence = []
+    labels = []
+    with open(filename, 'rb') as file1:
+        rest = b''
+        while True:
+            chunk = file1.read(chunk_size)
+            data = rest + chunk
+            if len(chunk) > 0:
+                cut = data.rfind(b'\n>')  # the last chain of the chunk may continue in the next chunk
+                if cut < 0:
+                    rest = data
+                    continue
+                data, rest = data[:cut + 1], data[cut + 1:]
+            words = []  # the words of the residues of the chunk
+            for block in data.split(b'>'):  # one block per chain
+                if len(block) == 0:
+                    continue
+                header, _, body = block.partition(b'\n')
+                block_words = body.split()
+                names.append(header.strip().decode())
+                sizes.append(len(block_words) // 4)
+                words += block_words
+            if len(words) > 0:
+                chain_ids.append(np.array(words[0::4], dtype=bytes))  # as wide as the longest value of the chunk
+                resids.append(np.array(words[1::4], dtype=bytes))
+                sequence.append(np.frombuffer(b''.join(words[2::4]), dtype=np.uint8))
+                labels.append(parse_labels(words[3::4], label_type))
+            del data, words
+            if len(chunk) == 0:
+                break
+    if len(labels) == 0:
+        chain_ids, resids, sequence = [np.zeros(0, dtype='S1')], [np.zeros(0, dtype='S1')], [np.zeros(0, np.uint8)]
+        labels = [np.zeros(0, dtype=label_type)]
+    table = {'names': names, 'offsets': np.cumsum(sizes, dtype=np.int64)}
+    for key, chunks in [('chain_ids', chain_ids), ('resids', resids), ('sequence', sequence), ('labels', labels)]:
+        table[key] = np.concatenate(chunks)
+        del chunks[:]  # the chunks of a column are freed before the next column is concatenated
+    return table
+
+
+def chain_sizes(table):
+    """
+    :param table: label table as returned from read_label_file
+    :return: numpy array, sizes[i] = number of residues of chain i
+    """
+    return np.diff(table['offsets'])
+
+
+def chain_sequence(table, i):
+    """
+    :param table: label table as returned from read_label_file
+    :param i: chain index
+    :return: the amino acids sequence of chain i
+    """
+    return table['sequence'][table['offsets'][i]:table['offsets'][i + 1]].tobytes().decode()
+
+
+def get_chain(table, i):
+    """
+    :param table: label table as returned from read_label_file or load_label_table
+    :param i: chain index
+    :return: tuple (name, chain_ids, resids, sequence, labels) of chain i. with a memory mapped table only the
+    residues of chain i are read
+    """
+    start, end = table['offsets'][i], table['offsets'][i + 1]
+    return (str(table['names'][i]), np.asarray(table['chain_ids'][start:end]), np.asarray(table['resids'][start:end]),
+            chain_sequence(table, i), np.asarray(table['labels'][start:end]))
+
+
+def to_lists(table):
+    """
+    :param table: label table as returned from read_label_file or load_label_table
+    :return: tuple (list_origins, list_sequences, list_resids, list_labels), as returned from
+    utilities.dataset_utils.read_labels: chain names, sequences, [Naa,2] arrays of (chain_id, resid) and label arrays
+    """
+    n = len(table['names'])
+    offsets = table['offsets']
+    list_origins = np.array(table['names'])
+    list_sequences = np.array([chain_sequence(table, i) for i in range(n)])
+    list_resids = np.empty(n, dtype=object)
+    list_labels = np.empty(n, dtype=object)
+    chain_ids = table['chain_ids'].astype(str)
+    resids = table['resids'].astype(str)
+    labels = table['labels'].astype(np.int64)
+    for i in range(n):
+        start, end = offsets[i], offsets[i + 1]
+        list_resids[i] = np.stack([chain_ids[start:end], resids[start:end]], axis=1)
+        list_labels[i] = labels[start:end]
+    return list_origins, list_sequences, list_resids, list_labels
+
+
+columns = ['offsets', 'chain_ids', 'resids', 'sequence', 'labels']  # the arrays of the binary format besides names
+
+
+def is_binary(path):
+    """
+    :param path: label file path
+    :return: True for the binary format (a directory, conventionally named *.labels), False for the text format
+    """
+    return not path.endswith('.txt')
+
+
+def find_labels(basename):
+    """
+    :param basename: label file path without extension
+    :return: basename.labels if it exists (binary format), basename.txt otherwise
+    """
+    return basename + '.labels' if os.path.isdir(basename + '.labels') else basename + '.txt'
+
+
+def write_label_table(table, folder):
+    """
+    :param table: label table as returned from read_label_file
+    :param folder: directory to write the binary format to: one .npy file per column (names.npy, offsets.npy, ...).
+    the columns are written to a temporary directory which then replaces folder
+    """
+    tmp_folder = folder.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    np.save(os.path.join(tmp_folder, 'names.npy'), np.array(table['names'], dtype=str))
+    for column in columns:
+        array = np.asarray(table[column])
+        if array.dtype.kind == 'S':  # the narrowest bytes width that holds the column, e.g. S1 for the chain ids
+            array = array.astype('S%s' % max(1, np.char.str_len(array).max(initial=1)))
+        np.save(os.path.join(tmp_folder, column + '.npy'), array)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+
+def load_label_table(folder, mmap=True):
+    """
+    :param folder: directory of the binary format, as written by write_label_table
+    :param mmap: if True, the residues columns are memory mapped and only the accessed chains are read from disk
+    :return: label table (see read_label_file), names is a numpy str array
+    """
+    table = {'names': np.load(os.path.join(folder, 'names.npy'))}
+    for column in columns:
+        table[column] = np.load(os.path.join(folder, column + '.npy'), mmap_mode='r' if mmap else None)
+    return table
+
+
+def read_labels(path):
+    """
+    :param path: label file, in the text format (*.txt) or the binary format
+    :return: label table (see read_label_file)
+    """
+    return load_label_table(path) if is_binary(path) else read_label_file(path)
+
+
+def write_label_file(table, filename):
+    """
+    :param table: label table as returned from read_label_file
+    :param filename: text label file to write, the inverse of read_label_file
+    """
+    with open(filename, 'wb') as file1:
+        write_label_lines(table, file1)
+
+
+def write_label_lines(table, file1):
+    """
+    :param table: label table as returned from read_label_file
+    :param file1: binary file object the chains are written to in the text format, after what it already holds
+    """
+    offsets = table['offsets']
+    for start in range(0, len(table['names']), 1024):  # a batch of chains at a time, bounded memory
+        end = min(start + 1024, len(table['names']))
+        residues = slice(offsets[start], offsets[end])
+        lines = np.char.add(np.char.add(np.asarray(table['chain_ids'][residues]), b' '),
+                            np.asarray(table['resids'][residues]))
+        lines = np.char.add(np.char.add(lines, b' '), np.asarray(table['sequence'][residues]).view('S1'))
+        labels = np.asarray(table['labels'][residues])
+        if np.issubdtype(labels.dtype, np.floating):  # distances, see dataCreation.mergeShards
+            labels = np.char.mod(b'%.3f', labels)
+        labels = labels.astype(bytes)  # as wide as the longest label
+        if labels.ndim == 2:  # multi-column labels, comma separated
+            columns_labels = labels
+            labels = columns_labels[:, 0]
+            for column in range(1, columns_labels.shape[1]):
+                labels = np.char.add(np.char.add(labels, b','), columns_labels[:, column])
+        lines = np.char.add(np.char.add(lines, b' '), labels)
+        for i in range(start, end):
+            file1.write(b'>' + str(table['names'][i]).encode() + b'\n')
+            chain_lines = lines[offsets[i] - offsets[start]:offsets[i + 1] - offsets[start]]
+            if len(chain_lines) > 0:
+                file1.write(b'\n'.join(chain_lines.tolist()) + b'\n')
+
+
+def write_labels(table, path):
+    """
+    :param table: label table as returned from read_label_file
+    :param path: label file, in the text format (*.txt) or the binary format
+    """
+    if is_binary(path):
+        write_label_table(table, path)
+    else:
+        write_label_file(table, path)
+
+
+class LabelWriter:
+    """
+    Writes a label file (text or binary, see is_binary) table by table, e.g. one structure at a time, so only the
+    appended table is held in memory. The text format is written as it comes. The binary columns are appended in
+    chunks to temporary files and copied into their .npy files (bytes columns as wide as their longest value) by
+    close, the offsets are built from the chains sizes at the end.
+
+        with label_file.LabelWriter('PSSM.labels') as writer:
+            for table in tables:
+                writer.append(table)
+    """
+
+    residue_columns = ['chain_ids', 'resids', 'sequence', 'labels']
+
+    def __init__(self, path):
+        """
+        :param path: label file to write, replaced on close
+        """
+        self.path = path
+        self.names = []
+        self.sizes = [0]
+        if not is_binary(path):
+            self.file = open(path, 'wb')
+            return
+        self.folder = path.rstrip('/') + '.tmp'
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+        self.chunk_files = {column: open(os.path.join(self.folder, column + '.chunks'), 'wb')
+                            for column in self.residue_columns}
+        self.dtypes = {}  # the widest dtype of the appended chunks of each column
+        self.shapes = {}  # the shape of a residue of each column, e.g. (Nclasses,) for multi-column labels
+
+    def append(self, table):
+        """
+        :param table: label table, its chains are written after the previous ones
+        """
+        self.names += [str(name) for name in table['names']]
+        self.sizes += chain_sizes(table).tolist()
+        if not is_binary(self.path):
+            write_label_lines(table, self.file)
+            return
+        for column in self.residue_columns:
+            array = np.asarray(table[column])
+            self.dtypes[column] = np.promote_types(self.dtypes.get(column, array.dtype), array.dtype)
+            if len(array) > 0:
+                self.shapes[column] = array.shape[1:]
+                np.save(self.chunk_files[column], array)
+
+    def close(self):
+        """
+        Completes the label file
+        """
+        if not is_binary(self.path):
+            self.file.close()
+            return
+        offsets = np.cumsum(self.sizes, dtype=np.int64)
+        np.save(os.path.join(self.folder, 'names.npy'), np.array(self.names, dtype=str))
+        np.save(os.path.join(self.folder, 'offsets.npy'), offsets)
+        default_dtypes = {'chain_ids': 'S1', 'resids': 'S1', 'sequence': np.uint8, 'labels': np.int8}
+        for column in self.residue_columns:
+            chunks_filename = self.chunk_files[column].name
+            self.chunk_files[column].close()
+            array = np.lib.format.open_memmap(os.path.join(self.folder, column + '.npy'), mode='w+',
+                                              dtype=self.dtypes.get(column, default_dtypes[column]),
+                                              shape=(int(offsets[-1]),) + self.shapes.get(column, ()))
+            position = 0
+            with open(chunks_filename, 'rb') as chunks_file:
+                while position < len(array):
+                    chunk = np.load(chunks_file)
+                    array[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+            array.flush()
+            del array
+            os.remove(chunks_filename)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.folder, self.path)
+
+    def discard(self):
+        """
+        Closes the files without completing the label file (the temporary files of the binary format are removed)
+        """
+        if not is_binary(self.path):
+            self.file.close()
+            return
+        for chunk_file in self.chunk_files.values():
+            chunk_file.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def convert(input_path, output_path):
+    """
+    :param input_path: label file to convert
+    :param output_path: converted label file, the format of each one is given by its path (see is_binary)
+    """
+    write_labels(read_labels(input_path), output_path)
+
+
+def take_chains(table, indexes):
+    """
+    :param table: label table
+    :param indexes: chain indexes
+    :return: label table of the chains of indexes, in this order
+    """
+    offsets = np.asarray(table['offsets'])
+    indexes = np.asarray(indexes, dtype=np.int64)
+    sizes = offsets[indexes + 1] - offsets[indexes]
+    new_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    residues = np.arange(new_offsets[-1]) + np.repeat(offsets[indexes] - new_offsets[:-1], sizes)
+    return {
+        'names': [str(table['names'][i]) for i in indexes],
+        'offsets': new_offsets,
+        'chain_ids': np.asarray(table['chain_ids'])[residues],
+        'resids': np.asarray(table['resids'])[residues],
+        'sequence': np.asarray(table['sequence'])[residues],
+        'labels': np.asarray(table['labels'])[residues],
+    }
+
+
+def concatenate_tables(tables):
+    """
+    :param tables: list of label tables
+    :return: label table of the chains of all the tables, in order
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+    labels = [np.asarray(table['labels']) for table in tables]
+    shape = max((label.shape[1:] for label in labels), key=len, default=())  # (Nclasses,) for multi-column labels
+    labels = [label.reshape((0,) + shape) if len(label) == 0 else label for label in labels]
+    for table in tables:
+        offsets.append(np.asarray(table['offsets'][1:]) + total)
+        total += int(table['offsets'][-1])
+    return {
+        'names': [str(name) for table in tables for name in table['names']],
+        'offsets': np.concatenate(offsets).astype(np.int64),
+        'chain_ids': np.concatenate([np.asarray(table['chain_ids']) for table in tables]).astype(bytes),
+        'resids': np.concatenate([np.asarray(table['resids']) for table in tables]).astype(bytes),
+        'sequence': np.concatenate([np.asarray(table['sequence']) for table in tables]).astype(np.uint8),
+        'labels': np.concatenate(labels),  # int8 labels or distances
+    }
+
+
+
+def chain_index(filename, chunk_size=1 << 24):
+    """
+    :param filename: text label file
+    :param chunk_size: number of bytes read at once
+    :return: tuple (names, byte_offsets). byte_offsets is a numpy int64 array [Nchains+1], the lines of chain i (its
+    header included) are the bytes byte_offsets[i]:byte_offsets[i+1] of the file. only the headers are parsed
+    """
+    names = []
+    starts = []
+    position = 0  # file position of data[0], always the start of a line
+    with open(filename, 'rb') as file1:
+        rest = b''
+        while True:
+            chunk = file1.read(chunk_size)
+            data = rest + chunk
+            if len(chunk) > 0:
+                cut = data.rfind(b'\n')  # the last line of the chunk may continue in the next chunk
+                if cut < 0:
+                    rest = data
+                    continue
+                data, rest = data[:cut + 1], data[cut + 1:]
+            array = np.frombuffer(data, dtype=np.uint8)
+            is_header = array == ord('>')
+            is_header[1:] &= array[:-1] == ord('\n')
+            for start in np.flatnonzero(is_header):
+                end = data.find(b'\n', start)
+                names.append(data[start + 1:end if end >= 0 else len(data)].strip().decode())
+                starts.append(position + start)
+            position += len(data)
+            if len(chunk) == 0:
+                break
+    return names, np.array(starts + [position], dtype=np.int64)
+
+
+def write_fold_files(filename, byte_offsets, folds, output_filenames, buffer_size=1 << 20):
+    """
+    :param filename: text label file
+    :param byte_offsets: chains byte offsets, as returned from chain_index
+    :param folds: numpy array, folds[i] = index in output_filenames of the file of chain i
+    :param output_filenames: the fold files to write
+    :param buffer_size: maximal number of bytes held in memory
+    Every run of consecutive chains of the same fold is copied to its fold file as raw bytes, in file order
+    """
+    folds = np.asarray(folds)
+    change = np.flatnonzero(np.diff(folds)) + 1
+    run_starts = np.concatenate([[0], change]).astype(np.int64)
+    run_ends = np.append(change, len(folds)).astype(np.int64)
+    output_files = [open(output_filename, 'wb') for output_filename in output_filenames]
+    try:
+        with open(filename, 'rb') as file1:
+            for start, end in zip(run_starts, run_ends) if len(folds) > 0 else []:
+                file1.seek(byte_offsets[start])
+                remaining = byte_offsets[end] - byte_offsets[start]
+                while remaining > 0:
+                    block = file1.read(min(buffer_size, remaining))
+                    output_files[folds[start]].write(block)
+                    remaining -= len(block)
+    finally:
+        for output_file in output_files:
+            output_file.close()
+
+
+def write_fold_index(folder, folds):
+    """
+    :param folder: directory of a binary label file
+    :param folds: numpy array, folds[i] = fold of chain i
+    The fold membership is saved as a column of the binary label file (folds.npy)
+    """
+    np.save(os.path.join(folder, 'folds.npy'), np.asarray(folds, dtype=np.int16))
+
+
+def load_fold(folder, fold, mmap=True):
+    """
+    :param folder: directory of a binary label file with a fold index (see write_fold_index)
+    :param fold: fold index
+    :return: label table of the chains of fold
+    """
+    table = load_label_table(folder, mmap=mmap)
+    folds = np.load(os.path.join(folder, 'folds.npy'))
+    return take_chains(table, np.flatnonzero(folds == fold))
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python label_file.py PSSM.txt PSSM.labels (text to binary), python label_file.py PSSM.labels PSSM.txt (back)
+    convert(sys.argv[1], sys.argv[2])
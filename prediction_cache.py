@@ -0,0 +1,125 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+import instrumentation
+
+
+def model_fingerprint(model_path):
+    """
+    :param model_path: path of the model without extension (as given to wrappers.load_model)
+    :return: sha1 hex digest of the content of the model files, changes whenever the model is retrained
+    """
+    digest = hashlib.sha1()
+    for filename in sorted(glob.glob(model_path + '.*')):
+        digest.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as file1:
+            for block in iter(lambda: file1.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def chain_key(inputs, i):
+    """
+    :param inputs: list of object arrays of chains
+    :param i: chain index
+    :return: sha1 hex digest of the inputs of chain i (shapes, dtypes and data)
+    """
+    digest = hashlib.sha1()
+    for input_ in inputs:
+        array = np.ascontiguousarray(input_[i])
+        digest.update(('%s%s' % (array.dtype.str, array.shape)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    On disk store of the per residue predictions of one model, keyed by the hash of the chain inputs.
+    The predictions are appended as float32 to a data file (read back through a memory map) and an index file
+    holds one "key offset length" line per chain. The file names include the model fingerprint and the prediction
+    variant, so a retrained model or different prediction settings never reuse stale predictions.
+    """
+
+    def __init__(self, folder, model_name, fingerprint, variant=''):
+        """
+        :param folder: directory of the cache files
+        :param model_name: name of the model
+        :param fingerprint: model fingerprint, as returned from model_fingerprint
+        :param variant: string of the prediction settings (e.g. padding lengths) that change the predictions
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tag = hashlib.sha1((fingerprint + variant).encode()).hexdigest()[:16]
+        self.data_filename = os.path.join(folder, '%s_%s.f32' % (model_name, tag))
+        self.index_filename = os.path.join(folder, '%s_%s.index.txt' % (model_name, tag))
+        self.index = {}  # index[key] = (offset, length), in float32 units
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'r') as file1:
+                for line in file1:
+                    words = line.split()
+                    if len(words) == 3:
+                        self.index[words[0]] = (int(words[1]), int(words[2]))
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, keys):
+        """
+        :param keys: list of chain keys
+        :return: tuple (predictions, missing). predictions is an object array with the cached prediction of each key
+        (None if not cached), missing is the list of indexes of the keys not in the cache
+        """
+        predictions = np.empty(len(keys), dtype=object)
+        missing = [i for i, key in enumerate(keys) if key not in self.index]
+        if len(missing) < len(keys):
+            data = np.memmap(self.data_filename, dtype=np.float32, mode='r')
+            for i, key in enumerate(keys):
+                if key in self.index:
+                    offset, length = self.index[key]
+                    predictions[i] = np.array(data[offset:offset + length])
+            del data
+        return predictions, missing
+
+    def put(self, keys, predictions):
+        """
+        :param keys: list of chain keys
+        :param predictions: per chain predictions of keys
+        """
+        offset = os.path.getsize(self.data_filename) // 4 if os.path.exists(self.data_filename) else 0
+        lines = []
+        with open(self.data_filename, 'ab') as data_file:
+            for key, prediction in zip(keys, predictions):
+                if key in self.index:
+                    continue
+                prediction = np.asarray(prediction, dtype=np.float32)
+                data_file.write(prediction.tobytes())
+                self.index[key] = (offset, len(prediction))
+                lines.append('%s %s %s\n' % (key, offset, len(prediction)))
+                offset += len(prediction)
+        with open(self.index_filename, 'a') as index_file:  # written after the data, an indexed entry is complete
+            index_file.writelines(lines)
+
+
+def cached_predict(cache, inputs, predict):
+    """
+    :param cache: PredictionCache of the model
+    :param inputs: list of object arrays of chains
+    :param predict: function (inputs subset) -> predictions of the chains, only called on the chains not cached
+    (the model is only loaded by predict if needed)
+    :return: object array of the chains predictions, in the order of inputs
+    """
+    keys = [chain_key(inputs, i) for i in range(len(inputs[0]))]
+    predictions, missing = cache.get(keys)
+    print('%s/%s chains predictions found in the cache' % (len(keys) - len(missing), len(keys)))
+    instrumentation.count('cached_chains', len(keys) - len(missing))
+    instrumentation.count('predicted_chains', len(missing))
+    if len(missing) > 0:
+        missing = np.array(missing)
+        new_predictions = predict([input_[missing] for input_ in inputs])
+        for i, prediction in zip(missing, new_predictions):
+            predictions[i] = prediction
+        cache.put([keys[i] for i in missing], new_predictions)
+    return predictions
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+import instrumentation
+
+'''
+A parsed structure is kept as a record of flat arrays, written once per .cif file (keyed by the file content hash)
+and memory mapped afterwards, so repeated labeling runs do not parse the structures again:
+    chain_ids: str [Nchains], chain_models: int32 [Nchains] (the model id of each chain, all the models are kept)
+    residue_chain: int32 [Nresidues], index of the chain of each residue
+    residue_names: bytes [Nresidues], residue_numbers: int32 [Nresidues], residue_icodes: bytes [Nresidues]
+    residue_offsets: int64 [Nresidues+1], the atoms of residue i are residue_offsets[i]:residue_offsets[i+1]
+    coordinates: float32 [Natoms,3], elements: bytes [Natoms]
+The chains and residues are in the Bio.PDB iteration order.
+'''
+
+record_arrays = ['chain_ids', 'chain_models', 'residue_chain', 'residue_names', 'residue_numbers', 'residue_icodes',
+                 'residue_offsets', 'coordinates', 'elements']
+
+
+def fileHash(filename):
+    """
+    :param filename: file to hash
+    :return: sha1 hex digest of the file content
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file1:
+        for block in iter(lambda: file1.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def structureRecord(structure):
+    """
+    :param structure: Bio.PDB structure
+    :return: the structure record (see above)
+    """
+    chain_ids = []
+    chain_models = []
+    residue_chain = []
+    residue_names = []
+    residue_numbers = []
+    residue_icodes = []
+    atom_counts = []
+    coordinates = []
+    elements = []
+    for model in structure:
+        for chain in model:
+            chain_index = len(chain_ids)
+            chain_ids.append(str(chain.get_id()))
+            chain_models.append(model.get_id())
+            for residue in chain:
+                atoms = list(residue.get_atoms())
+                residue_chain.append(chain_index)
+                residue_names.append(str(residue.get_resname()))
+                residue_numbers.append(residue.get_id()[1])
+                residue_icodes.append(residue.get_id()[2])
+                atom_counts.append(len(atoms))
+                coordinates += [atom.get_coord() for atom in atoms]
+                elements += [atom.element for atom in atoms]
+    return {
+        'chain_ids': np.array(chain_ids, dtype=str),
+        'chain_models': np.array(chain_models, dtype=np.int32),
+        'residue_chain': np.array(residue_chain, dtype=np.int32),
+        'residue_names': np.array(residue_names, dtype=bytes),
+        'residue_numbers': np.array(residue_numbers, dtype=np.int32),
+        'residue_icodes': np.array(residue_icodes, dtype=bytes),
+        'residue_offsets': np.concatenate([[0], np.cumsum(atom_counts, dtype=np.int64)]).astype(np.int64),
+        'coordinates': np.array(coordinates, dtype=np.float32).reshape(-1, 3),
+        'elements': np.array(elements, dtype=bytes),
+    }
+
+
+def saveRecord(record, folder):
+    """
+    :param record: structure record
+    :param folder: directory to write the record to, one .npy file per array (written to a temporary directory that
+    then replaces folder, so a record is either complete or missing)
+    """
+    tmp_folder = folder.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for name in record_arrays:
+        np.save(os.path.join(tmp_folder, name + '.npy'), record[name])
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+
+def loadRecord(folder, mmap=True):
+    """
+    :param folder: directory of a record written by saveRecord
+    :param mmap: if True, the arrays are memory mapped
+    :return: structure record
+    """
+    return {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r' if mmap else None)
+            for name in record_arrays}
+
+
+def loadStructure(pdb_name, structure_filename, cacheFolder):
+    """
+    :param pdb_name: pdb id of the structure
+    :param structure_filename: the .cif file of the structure
+    :param cacheFolder: directory of the records, one subdirectory per file hash
+    :return: structure record. the .cif file is parsed with Bio.PDB only if its content has no record yet
+    """
+    folder = os.path.join(cacheFolder, fileHash(structure_filename))
+    if not os.path.isdir(folder):
+        from Bio.PDB.MMCIFParser import MMCIFParser
+
+        structure = MMCIFParser(QUIET=True).get_structure(pdb_name, structure_filename)
+        saveRecord(structureRecord(structure), folder)
+        instrumentation.count('structures_parsed')
+    return loadRecord(folder)
+
+
+def residueAtoms(record, residues):
+    """
+    :param record: structure record
+    :param residues: numpy array of residue indexes
+    :return: tuple (atoms, atom_residue): the atom indexes of the residues, in order, and for each atom the position in
+    residues of its residue
+    """
+    offsets = np.asarray(record['residue_offsets'])
+    residues = np.asarray(residues, dtype=np.int64)
+    counts = offsets[residues + 1] - offsets[residues]
+    starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    atoms = np.arange(starts[-1]) + np.repeat(offsets[residues] - starts[:-1], counts)
+    return atoms, np.repeat(np.arange(len(residues)), counts)
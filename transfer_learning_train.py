@@ -1,101 +1,92 @@
+import collections
+import multiprocessing
 import os
+import pickle
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
-from keras.callbacks import EarlyStopping, ReduceLROnPlateau
-from keras.optimizers import Adam
 
+import bucketing
+import fold_dataset
 import histogram
-import preprocessing.pipelines as pipelines
-import utilities.dataset_utils as dataset_utils
+import instrumentation
+import label_file
+import prediction_cache
 import utilities.paths as paths
-import utilities.wrappers as wrappers
-from train import make_PR_curves
 
-if __name__ == '__main__':
-    '''
-    Script to train and evaluate ScanNet on the B-cell epitope data set.
-    Model is trained via transfer learning, using the PPBS model as starting point.
-    Five-fold cross-validation is used, i.e. five models are trained.
-    '''
-    check = False  # Check = True to verify installation, =False for full training.
-    train = False  # True to retrain, False to evaluate the model shown in paper.
-    transfer = True  # If False, retrain from scratch.
-    freeze = False  # If True, evaluate the binding site network without fine tuning.
-    use_evolutionary = False  # True to use evolutionary information (requires hhblits and a sequence database), False otherwise.
-    Lmax_aa = 256 if check else 2120
-    ''' 
-    Lmax_aa is the maximum length of the protein sequences.
-    Sequences longer than Lmax_aa are truncated, sequences shorter are grouped and processed using the protein serialization trick (see Materials and Methods of paper).
-    If memory allows it, use the largest protein length found in the dataset.
-    In the paper, we used Lmax_aa = 2120, which was the largest antigen in the dataset (two chains of a SARS-CoV-2 spike protein)
-    '''
-    epochs_max = 2 if check else 100
-
-    ncores = 4
 
-    if train:  # Retrain model.
+def get_dataset_names(config):
+    """
+    :param config: config.Config of the run
+    :return: tuple (list_datasets, list_dataset_names), e.g. (['fold1', ...], ['Fold 1', ...])
+    """
+    list_datasets = ['fold%s' % (k + 1) for k in range(config.folds)]
+    list_dataset_names = ['Fold %s' % (k + 1) for k in range(config.folds)]
+    return list_datasets, list_dataset_names
+
+
+def get_model_names(config):
+    """
+    :param config: config.Config of the run
+    :return: tuple (model_name, root_model_name, model_names). root_model_name is the initial model of the
+    retraining (None when evaluating the paper model), model_names[k] is the model of fold k
+    """
+    root_model_name = None
+    if config.train:  # Retrain model.
         model_name = 'ScanNet_PAI_retrained'
         root_model_name = 'ScanNet_PPI'  # The initial model.
-        if len(sys.argv) > 1:  # python transfer_learning_train.py 1/2/...
-            model_name += '_%s' % sys.argv[1]  # Retrain multiple times for error bars.
-            root_model_name += '_retrained_%s' % sys.argv[1]  # Retrain multiple times for error bars.
-        if not use_evolutionary:
+        if config.retrain_index is not None:
+            model_name += '_%s' % config.retrain_index  # Retrain multiple times for error bars.
+            root_model_name += '_retrained_%s' % config.retrain_index  # Retrain multiple times for error bars.
+        if not config.use_evolutionary:
             model_name += '_noMSA'
             root_model_name += '_noMSA'
-        if not transfer:
+        if not config.transfer:
             model_name += '_scratch'
-        if freeze:
+        if config.freeze:
             model_name += '_freeze'
-        if check:
+        if config.check:
             model_name += '_check'
 
     else:  # Evaluate paper model.
         model_name = 'ScanNet_PAI'
-        if not use_evolutionary:
+        if not config.use_evolutionary:
             model_name += '_noMSA'
 
-    model_names = [model_name + '_%s' % k for k in range(5)]
+    model_names = [model_name + '_%s' % k for k in range(config.folds)]
+    return model_name, root_model_name, model_names
 
-    list_datasets = [
-        'fold1',
-        'fold2',
-        'fold3',
-        'fold4',
-        'fold5',
-    ]
 
-    list_dataset_names = [
-        'Fold 1',
-        'Fold 2',
-        'Fold 3',
-        'Fold 4',
-        'Fold 5'
-    ]
-
-    # %% Gather and preprocess each dataset.
+def build_folds(config, fold_indexes=None):
+    """
+    :param config: config.Config of the run
+    :param fold_indexes: indexes of the folds to process, None for all the folds
+    :return: fold_dataset.FoldDataset of the processed folds (the other folds are missing)
+    """
+    import pandas as pd
+    import preprocessing.pipelines as pipelines
 
+    list_datasets, list_dataset_names = get_dataset_names(config)
     pipeline = pipelines.ScanNetPipeline(
         with_atom=True,
-        aa_features='pwm' if use_evolutionary else 'sequence',
+        aa_features='pwm' if config.use_evolutionary else 'sequence',
     )
 
-    list_dataset_locations = ['datasets/BCE/labels_%s.txt' % dataset for dataset in list_datasets]
+    list_dataset_locations = [label_file.find_labels('datasets/BCE/labels_%s' % dataset) for dataset in list_datasets]
     dataset_table = pd.read_csv('datasets/BCE/table.csv', sep=',')
 
-    list_inputs = []
-    list_outputs = []
-    list_weights = []
+    folds = fold_dataset.FoldDataset()  # Each processed fold is kept once; train/test splits are chain views.
 
-    for dataset, dataset_name, dataset_location in zip(list_datasets, list_dataset_names, list_dataset_locations):
+    for k in (range(config.folds) if fold_indexes is None else fold_indexes):
+        dataset, dataset_name, dataset_location = list_datasets[k], list_dataset_names[k], list_dataset_locations[k]
         # Parse label files
         (list_origins,  # List of chain identifiers (e.g. [1a3x_A,10gs_B,...])
          list_sequences,  # List of corresponding sequences.
          list_resids,  # List of corresponding residue identifiers.
-         list_labels) = dataset_utils.read_labels(dataset_location)  # List of residue-wise labels
+         list_labels) = label_file.to_lists(label_file.read_labels(dataset_location))  # List of residue-wise labels
 
-        if check:
+        if config.check:
             list_origins = list_origins[:10]
             list_sequences = list_sequences[:10]
             list_resids = list_resids[:10]
@@ -110,7 +101,7 @@ if __name__ == '__main__':
         5. If labels are provided, aligns them onto the residues found in the pdb file.
         '''
         inputs, outputs, failed_samples = pipeline.build_processed_dataset(
-            'BCE_%s' % (dataset + '_check' if check else dataset),
+            'BCE_%s' % (dataset + '_check' if config.check else dataset),
             list_origins=list_origins,  # Mandatory
             list_resids=list_resids,  # Optional
             list_labels=list_labels,  # Optional
@@ -119,7 +110,7 @@ if __name__ == '__main__':
             save=True,
             # Whether to save the results in pickle file format. Files are stored in the pipeline_folder defined in paths.py
             fresh=False,  # If fresh = False, attemps to load pickle files first.
-            ncores=ncores
+            ncores=config.ncores
         )
 
         # weights = np.array(dataset_table['Sample weight'][ dataset_table['Set'] == dataset_name ] )
@@ -130,9 +121,7 @@ if __name__ == '__main__':
 
         print("len(inputs) = ", len(inputs))
 
-        list_inputs.append(inputs)
-        list_outputs.append(outputs)
-        list_weights.append(weights)
+        folds.add_fold(inputs, outputs, weights, fold=k)
 
     '''
     Input format:
@@ -152,30 +141,119 @@ if __name__ == '__main__':
 
     Weight format: List of chain-wise weights (optional).
     '''
-
-    all_cross_predictions = []
-    all_cross_test_label = []
-
-    for k in range(5):  # 5-fold training/evaluation.
-        not_k = [i for i in range(5) if i != k]
-        train_inputs = [np.concatenate([list_inputs[i][j] for i in not_k]) for j in range(len(list_inputs[0]))]
-        train_outputs = np.concatenate([list_outputs[i] for i in not_k])
-        train_weights = np.concatenate([list_weights[i] for i in not_k])
-
-        test_inputs = list_inputs[k]
-        test_outputs = list_outputs[k]
-        test_weights = list_weights[k]
-
-        if train:
-            # %% Load initial model.
+    return folds
+
+
+def preprocess_fold(config, k, load=True):
+    """
+    :param config: config.Config of the run
+    :param k: fold index
+    :param load: if True, the processed fold is returned, otherwise it is only processed and saved (pickle files of
+    the pipeline) for the fold processes to load it
+    :return: tuple (inputs, outputs, weights) of fold k, None if not load
+    """
+    instrumentation.configure_from(config)  # the preprocessing processes are spawned, without the parent's settings
+    with instrumentation.stage('preprocess_fold', fold=k):
+        folds = build_folds(config, [k])
+    if load:
+        return folds.inputs[k], folds.outputs[k], folds.weights[k]
+
+
+def prefetch_folds(config, load=True):
+    """
+    :param config: config.Config of the run. the folds are preprocessed by config.prefetch_workers background
+    processes, at most config.prefetch_depth folds ahead of the consumer (a bounded queue of pending folds)
+    :param load: if True, the processed folds are sent back to this process (see preprocess_fold)
+    :return: generator of tuples (k, fold) in the order of the folds, fold = (inputs, outputs, weights) or None. the
+    next folds are preprocessed while the consumer works on fold k
+    """
+    context = multiprocessing.get_context('spawn')  # Fresh processes, as the fold processes.
+    with ProcessPoolExecutor(max_workers=config.prefetch_workers, mp_context=context) as executor:
+        pending = collections.deque()
+        for k in range(config.folds):
+            while len(pending) < max(1, config.prefetch_depth) and k + len(pending) < config.folds:
+                pending.append(executor.submit(preprocess_fold, config, k + len(pending), load))
+            yield k, pending.popleft().result()
+
+
+def predictions_filename(config, k):
+    """
+    :param config: config.Config of the run
+    :param k: fold index
+    :return: path of the test predictions file of fold k
+    """
+    return paths.library_folder + 'predictions/%s.pkl' % get_model_names(config)[2][k]
+
+
+def run_fold(config, k, folds=None, split=None):
+    """
+    Measured fold_predictions (see instrumentation.py), the entry point of the fold processes.
+    :param config: config.Config of the run
+    :param k: index of the test fold
+    :param folds: optional FoldDataset, if None the folds are loaded from the pipeline pickle files
+    :param split: optional train and test sets of fold k (see fold_predictions)
+    :return: path of the saved predictions
+    """
+    instrumentation.configure_from(config)  # the fold processes are spawned, without the settings of the parent
+    with instrumentation.stage('fold', fold=k):
+        return fold_predictions(config, k, folds=folds, split=split)
+
+
+def fold_predictions(config, k, folds=None, split=None):
+    """
+    Train (if config.train) or load the model of fold k, predict its test set and save the predictions.
+    :param config: config.Config of the run
+    :param k: index of the test fold
+    :param folds: optional FoldDataset, if None the folds are loaded from the pipeline pickle files
+    :param split: optional tuple (train, test) as returned from FoldDataset.split(k), built by the caller. a fold
+    process then receives only the chains of its own train and test sets, and folds is not used
+    :return: path of the saved predictions, a pickle of (test_outputs, test_predictions, test_weights)
+    """
+    from keras.callbacks import EarlyStopping, ReduceLROnPlateau
+    from keras.optimizers import Adam
+
+    import utilities.wrappers as wrappers
+
+    if split is None:
+        if folds is None:
+            folds = build_folds(config, None if config.train else [k])  # The evaluation only needs the test fold.
+        split = folds.split(k) if config.train else (None, folds.subset([k]))
+        del folds  # Only the train/test views of this fold are needed from here on.
+    train, (test_inputs, test_outputs, test_weights) = split
+    if config.train:
+        train_inputs, train_outputs, train_weights = train
+    del split, train
+
+    Lmax_aa = config.Lmax_aa
+    use_buckets = config.use_buckets
+    bucket_lengths = config.bucket_lengths
+    token_budget = config.token_budget
+    _, root_model_name, model_names = get_model_names(config)
+
+    if config.train:
+        # %% Load initial model.
+        if use_buckets:  # One model per bucket length, the weights are carried from bucket to bucket.
+            bucket_models = {L: wrappers.load_model(paths.model_folder + root_model_name, Lmax=L,
+                                                    load_weights=config.transfer) for L in bucket_lengths}
+            model = bucket_models[Lmax_aa]
+        else:
             model = wrappers.load_model(paths.model_folder + root_model_name, Lmax=Lmax_aa,
-                                        load_weights=transfer)  # If transfer, load weights from root network; otherwise, only load architecture and loss.
-            if not freeze:
-                optimizer = Adam(lr=1e-4, beta_2=0.99, epsilon=1e-4)
-                model.model.compile(loss='categorical_crossentropy', optimizer=optimizer, metrics=[
+                                        load_weights=config.transfer)  # If transfer, load weights from root network; otherwise, only load architecture and loss.
+        if not config.freeze:
+            for compiled_model in (bucket_models.values() if use_buckets else [model]):
+                optimizer = Adam(lr=1e-4, beta_2=0.99, epsilon=1e-4)  # The state is carried by fit_bucketed.
+                compiled_model.model.compile(loss='categorical_crossentropy', optimizer=optimizer, metrics=[
                     'categorical_crossentropy',
                     'categorical_accuracy']),  # Recompile model with an optimizer with lower learning rate.
-                extra_params = {'batch_size': 1, 'epochs': epochs_max}
+            print('Starting training for fold %s...' % k)
+            if use_buckets:
+                model = bucketing.fit_bucketed(bucket_models, train_inputs, train_outputs, train_weights,
+                                               token_budget, config.epochs_max,
+                                               validation_data=(test_inputs, test_outputs, test_weights),
+                                               patience=2, min_delta=0.001, lr_factor=0.5, lr_patience=2,
+                                               lr_cooldown=1)
+            else:
+                extra_params = {'batch_size': 1, 'epochs': config.epochs_max}
 
                 # %% Train!
                 extra_params['validation_data'] = (
@@ -186,55 +264,182 @@ if __name__ == '__main__':
                     ReduceLROnPlateau(monitor='val_categorical_crossentropy', factor=0.5,
                                       patience=2, verbose=1, mode='min', min_delta=0.001, cooldown=1)
                 ]
-                print('Starting training for fold %s...' % k)
                 history = model.fit(train_inputs, train_outputs, sample_weight=train_weights, **extra_params)
-                print('Training completed for fold %s! Saving model' % k)
-                model.save(paths.model_folder + model_names[k])
-        else:
-            # No training. Load trained model.
+            print('Training completed for fold %s! Saving model' % k)
+            model.save(paths.model_folder + model_names[k])
+    else:
+        # No training. The trained model is only loaded if some test chains are not in the prediction cache.
+        bucket_models = None
+        model = None
+
+    def predict(inputs):
+        nonlocal bucket_models, model
+        if use_buckets:
+            if bucket_models is None:
+                bucket_models = {L: wrappers.load_model(paths.model_folder + model_names[k], Lmax=L)
+                                 for L in bucket_lengths}
+            return bucketing.predict_bucketed(bucket_models, inputs, bucketing.chain_lengths(inputs[0]), token_budget)
+        if model is None:
             model = wrappers.load_model(paths.model_folder + model_names[k], Lmax=Lmax_aa)
-
-        # %% Predict for test set and evaluate performance.
-
-        print('Performing predictions on the test set for fold %s...' % (k + 1))
-        test_predictions = model.predict(
-            test_inputs,
+        return model.predict(
+            inputs,
             return_all=False,
             # Only return the binding site probability p. return_all=True gives [1-p,p] for each residue.
             batch_size=1)
-        all_cross_predictions.append(test_predictions)
-        all_cross_test_label.append(test_outputs)
-
-    all_cross_predictions = np.concatenate(all_cross_predictions)
-    all_cross_test_label = np.concatenate(all_cross_test_label)
-
-    all_predictions_as_one_list = np.concatenate(all_cross_predictions)
-    label0_list, label1_list = histogram.create_label_lists(all_cross_test_label, all_cross_predictions)
-    histogram.create_labels_histogram(label0_list, label1_list)
-    threshold33 = histogram.find_threshold(0.333, label0_list, label1_list,all_predictions_as_one_list)
-    threshold50 = histogram.find_threshold(0.5, label0_list, label1_list,all_predictions_as_one_list)
-    threshold25 = histogram.find_threshold(0.25, label0_list, label1_list,all_predictions_as_one_list)
+
+    # %% Predict for test set and save the predictions for the aggregation.
+
+    print('Performing predictions on the test set for fold %s...' % (k + 1))
+    if config.use_prediction_cache and not (config.train and config.freeze):  # frozen models are not saved
+        cache = prediction_cache.PredictionCache(
+            paths.library_folder + 'prediction_cache/', model_names[k],
+            prediction_cache.model_fingerprint(paths.model_folder + model_names[k]),
+            variant='buckets_%s_%s' % (bucket_lengths, token_budget) if use_buckets else 'Lmax_%s' % Lmax_aa)
+        test_predictions = prediction_cache.cached_predict(cache, test_inputs, predict)
+    else:
+        test_predictions = predict(test_inputs)
+
+    filename = predictions_filename(config, k)
+    with open(filename, 'wb') as file1:
+        pickle.dump((test_outputs, test_predictions, test_weights), file1)
+    return filename
+
+
+def limit_threads(threads):
+    """
+    :param threads: maximal number of threads of each fold process (BLAS, OpenMP and tensorflow thread pools).
+    Set in the environment before the fold processes are started, so they inherit it.
+    """
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                     'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']:
+        os.environ[variable] = str(threads)
+
+
+def run_folds(config):
+    """
+    :param config: config.Config of the run. config.fold_workers folds run at the same time, each one in its own
+    process with at most config.threads_per_worker threads (1 runs the folds one after the other in this process)
+    :return: list of the predictions files, in the order of the folds
+    """
+    nfolds = config.folds
+    fold_workers = config.fold_workers
+    limit_threads(config.threads_per_worker)
+    if config.prefetch_workers > 0:
+        return run_folds_prefetched(config)
+    if fold_workers == 1:
+        with instrumentation.stage('build_folds'):
+            folds = build_folds(config)
+        return [run_fold(config, k, folds=folds) for k in range(nfolds)]
+    # The folds are preprocessed (and pickled) once here. A training process receives its train and test sets, built
+    # here as views of the folds, an evaluation process loads its own fold from the pickles.
+    with instrumentation.stage('build_folds'):
+        folds = build_folds(config)
+    if not config.train:
+        del folds
+    context = multiprocessing.get_context('spawn')  # Fresh processes, no tensorflow state is forked.
+    with ProcessPoolExecutor(max_workers=fold_workers, mp_context=context) as executor:
+        if config.train:
+            futures = [executor.submit(run_fold, config, k, split=folds.split(k)) for k in range(nfolds)]
+        else:
+            futures = [executor.submit(run_fold, config, k) for k in range(nfolds)]
+        return [future.result() for future in futures]
+
+
+def run_folds_prefetched(config):
+    """
+    :param config: config.Config of the run
+    :return: list of the predictions files, in the order of the folds
+    run_folds with the preprocessing in the background (see prefetch_folds). An evaluation of fold k starts as soon as
+    fold k is preprocessed, while the next folds are preprocessed. A training of fold k uses all the other folds, so
+    the trainings start once the last fold is preprocessed (the folds are still preprocessed by
+    config.prefetch_workers processes at the same time), and each training process receives only its train and test
+    sets (views of the folds gathered here)
+    """
+    nfolds = config.folds
+    if config.fold_workers == 1:
+        filenames = []
+        folds = fold_dataset.FoldDataset()
+        for k, fold in prefetch_folds(config):
+            if config.train:
+                folds.add_fold(*fold, fold=k)
+            else:  # Only fold k is kept, until its predictions are saved.
+                test_fold = fold_dataset.FoldDataset()
+                test_fold.add_fold(*fold, fold=k)
+                filenames.append(run_fold(config, k, folds=test_fold))
+        if config.train:
+            filenames = [run_fold(config, k, folds=folds) for k in range(nfolds)]
+        return filenames
+    context = multiprocessing.get_context('spawn')  # Fresh processes, no tensorflow state is forked.
+    with ProcessPoolExecutor(max_workers=config.fold_workers, mp_context=context) as executor:
+        if config.train:  # Each preprocessing process returns its own fold, the train sets are views built here.
+            folds = fold_dataset.FoldDataset()
+            for k, fold in prefetch_folds(config):
+                folds.add_fold(*fold, fold=k)
+            futures = [executor.submit(run_fold, config, k, split=folds.split(k)) for k in range(nfolds)]
+        else:
+            futures = [executor.submit(run_fold, config, k)  # The fold processes load their fold from the pickles.
+                       for k, _ in prefetch_folds(config, load=False)]
+        return [future.result() for future in futures]
+
+
+def aggregate_folds(config, filenames):
+    """
+    Evaluate the cross-validation from the saved predictions: AUCs, thresholds, histograms and PR curves.
+    :param config: config.Config of the run
+    :param filenames: predictions files of the folds, as returned from run_folds
+    """
+    model_name = get_model_names(config)[0]
+    metrics = histogram.MetricsAccumulator(bins=1000)  # Binned predictions, updated fold by fold.
+    for k, filename in enumerate(filenames):
+        with open(filename, 'rb') as file1:
+            test_outputs, test_predictions, test_weights = pickle.load(file1)
+        metrics.update(test_outputs, test_predictions, weights=test_weights, fold=k)
+        print('AUCPR for fold %s: %.3f' % (k + 1, metrics.auc_pr(fold=k)))
+
+    metrics.plot_histograms()
+    (threshold33, threshold50, threshold25), _ = metrics.thresholds(precisions=[0.333, 0.5, 0.25])
     print(threshold33)
     print(threshold50)
     print(threshold25)
-
-
-    all_labels = np.concatenate([np.array([
-        np.argmax(label, axis=1)[:Lmax_aa]  # Back to 0-1 labels from one-hot encoding.
-        for label in list_outputs[i]]) for i in range(5)])
-    all_weights = np.concatenate(list_weights)
+    print('Cross-validation AUCPR: %.3f, AUCROC: %.3f' % (metrics.auc_pr(), metrics.auc_roc()))
 
     if not os.path.isdir(paths.library_folder + 'plots/'):
         os.mkdir(paths.library_folder + 'plots/')
 
-    fig, ax = make_PR_curves(
-        [all_labels],
-        [all_cross_predictions],
-        [all_weights],
-        ['Cross-validation'],
+    fig, ax = metrics.plot_pr_curves(
         title='B-cell epitope prediction: %s' % model_name,
         figsize=(10, 10),
-        margin=0.05, grid=0.1
-        , fs=25)
+        fs=25)
 
     fig.savefig(paths.library_folder + 'plots/PR_curve_BCE_%s.png' % model_name, dpi=300)
+
+
+def cross_validation(config):
+    """
+    :param config: config.Config of the run
+    Train (if config.train) and evaluate the models of the folds, then evaluate the cross-validation.
+    """
+    if not os.path.isdir(paths.library_folder + 'predictions/'):
+        os.mkdir(paths.library_folder + 'predictions/')
+
+    instrumentation.configure_from(config)
+    with instrumentation.stage('cross_validation'):
+        # %% 5-fold training/evaluation, each fold writes its model and test predictions to disk.
+        prediction_files = run_folds(config)
+
+        # %% Evaluate the cross-validation from the saved predictions.
+        with instrumentation.stage('aggregate'):
+            aggregate_folds(config, prediction_files)
+
+
+if __name__ == '__main__':
+    '''
+    Script to train and evaluate ScanNet on the B-cell epitope data set.
+    Model is trained via transfer learning, using the PPBS model as starting point.
+    Five-fold cross-validation is used, i.e. five models are trained.
+    The parameters (check, train, transfer, freeze, Lmax_aa, ...) are set in config.py or from the command line,
+    see python ubiqpred.py train --help.
+    '''
+    from config import Config
+
+    cross_validation(Config(retrain_index=sys.argv[1] if len(sys.argv) > 1 else None))  # python transfer_learning_train.py 1/2/...
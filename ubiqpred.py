@@ -0,0 +1,121 @@
+import argparse
+import sys
+
+from config import Config
+
+
+def parse_bool(value):
+    """
+    :param value: command line value, true/false (or 1/0, yes/no)
+    :return: the boolean value
+    """
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise argparse.ArgumentTypeError('expected true or false, got %s' % value)
+
+
+def parse_int_list(value):
+    """
+    :param value: command line value, comma separated integers
+    :return: list of the integers
+    """
+    return [int(item) for item in value.split(',')]
+
+
+def parse_float_list(value):
+    """
+    :param value: command line value, comma separated numbers
+    :return: list of the numbers
+    """
+    return [float(item) for item in value.split(',')]
+
+
+common_parameters = ['ncores', 'metrics_filename', 'profile_folder']
+stage_parameters = {
+    'label': ['pdb_folder', 'label_filename', 'shards_folder', 'structure_cache', 'thresholds', 'distances_filename',
+              'heavy_atoms', 'partners_filename'],
+    'split': ['label_filename', 'cath_filename', 'cath_columns', 'identity_cache', 'folds'],
+    'build': ['pdb_folder', 'label_filename', 'shards_folder', 'structure_cache', 'thresholds', 'distances_filename',
+              'heavy_atoms', 'partners_filename', 'cath_filename', 'cath_columns', 'identity_cache', 'folds',
+              'manifest_filename'],
+    'train': ['folds', 'check', 'transfer', 'freeze', 'use_evolutionary', 'Lmax_aa', 'epochs_max', 'retrain_index',
+              'use_buckets', 'bucket_lengths', 'token_budget', 'fold_workers', 'threads_per_worker',
+              'use_prediction_cache', 'prefetch_workers', 'prefetch_depth'],
+    'evaluate': ['folds', 'check', 'use_evolutionary', 'Lmax_aa', 'use_buckets', 'bucket_lengths', 'token_budget',
+                 'fold_workers', 'threads_per_worker', 'use_prediction_cache', 'prefetch_workers', 'prefetch_depth'],
+}
+parameter_types = {
+    'cath_columns': int, 'folds': int, 'Lmax_aa': int, 'epochs_max': int, 'token_budget': int, 'fold_workers': int,
+    'threads_per_worker': int, 'prefetch_workers': int, 'prefetch_depth': int, 'ncores': int,
+    'bucket_lengths': parse_int_list, 'thresholds': parse_float_list,
+    'check': parse_bool, 'transfer': parse_bool, 'freeze': parse_bool, 'use_evolutionary': parse_bool,
+    'use_buckets': parse_bool, 'use_prediction_cache': parse_bool, 'heavy_atoms': parse_bool,
+}
+
+
+def command_label(config):
+    import dataCreation
+
+    dataCreation.label(config)
+
+
+def command_split(config):
+    import cath
+
+    cath.split(config)
+
+
+def command_build(config):
+    import dataset_build
+
+    dataset_build.build(config)
+
+
+def command_cross_validation(config):
+    import transfer_learning_train
+
+    transfer_learning_train.cross_validation(config)
+
+
+commands = {
+    'label': (command_label, 'label the structures chains (dataCreation.py)'),
+    'split': (command_split, 'divide the labeled chains to homologous folds (cath.py)'),
+    'build': (command_build, 'incremental label + split, only the new or changed structures (dataset_build.py)'),
+    'train': (command_cross_validation, 'retrain the models with 5-fold cross-validation and evaluate them'),
+    'evaluate': (command_cross_validation, 'evaluate the trained models with 5-fold cross-validation'),
+}
+
+
+def make_parser():
+    """
+    :return: argparse parser with a subcommand for every stage, the options of each stage are its Config parameters
+    """
+    parser = argparse.ArgumentParser(prog='ubiqpred', description='UbiqPred: ubiquitin binding domains prediction')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, (_, help_text) in commands.items():
+        subparser = subparsers.add_parser(command, help=help_text)
+        for parameter in common_parameters + stage_parameters[command]:
+            subparser.add_argument('--' + parameter.replace('_', '-'), dest=parameter,
+                                   type=parameter_types.get(parameter, str), default=None,
+                                   help='default: %s' % Config.defaults[parameter])
+    return parser
+
+
+def main(argv=None):
+    """
+    :param argv: command line arguments (without the program name), None for sys.argv[1:]
+    """
+    args = vars(make_parser().parse_args(argv))
+    command = args.pop('command')
+    overrides = {key: value for key, value in args.items() if value is not None}
+    if command in ('train', 'evaluate'):
+        overrides['train'] = command == 'train'
+    config = Config(**overrides)
+    print(config)
+    commands[command][0](config)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])